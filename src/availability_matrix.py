@@ -0,0 +1,259 @@
+import argparse
+import random
+import threading
+import time
+
+import numpy as np
+
+from models import Product, Store, LatestAvailability
+from common import logger
+
+
+class AvailabilityMatrix:
+    """
+    In-memory copy of the latest availability of every part at every store.
+
+    Stores and parts are mapped to dense integer indices, and availability and
+    inventory are kept in (parts x stores) NumPy arrays, together with per-part
+    and per-store counts of available pairs. So "is this part available
+    anywhere?" is O(1), "what is in stock at this store?" is one vectorized
+    pass over a column, and aggregations by model / capacity / finish are
+    bincounts.
+
+    The matrix is rebuilt from the database on first query (the scheduler loads
+    it at startup), and from then on kept up to date with each observation as
+    it is ingested; until it is loaded, observations are ignored. It also knows every product
+    and when each pair was last seen, so that with write-behind the scheduler
+    can pick what to poll while the database is unavailable.
+    """
+    ATTRIBUTES = ("model", "capacity", "finish")
+    PRODUCT_FIELDS = ("product_title",) + ATTRIBUTES
+
+    def __init__(self, part_capacity=64, store_capacity=32):
+        self._lock = threading.RLock()
+        self.loaded = False
+        self._reset(part_capacity, store_capacity)
+
+    def _reset(self, part_capacity, store_capacity):
+        self.part_index: dict[str, int] = {}
+        self.store_index: dict[str, int] = {}
+        self.parts: list[str] = []
+        self.stores: list[str] = []
+        self.listed_stores: list[int] = []  # indices of the stores in the stores table
+        self.attributes: dict[str, list[str | None]] = {name: [] for name in self.PRODUCT_FIELDS}
+
+        self.available = np.zeros((part_capacity, store_capacity), dtype=bool)
+        self.inventory = np.zeros((part_capacity, store_capacity), dtype=np.int32)
+        self.updated_at = np.full((part_capacity, store_capacity), np.nan)  # unix time, NaN if never seen
+        self.part_available_count = np.zeros(part_capacity, dtype=np.int32)  # stores where the part is available
+        self.store_available_count = np.zeros(store_capacity, dtype=np.int32)  # parts available at the store
+
+    def _grow(self, parts, stores):
+        """ Make room for at least `parts` x `stores`, doubling the capacity """
+        part_capacity, store_capacity = self.available.shape
+        if parts <= part_capacity and stores <= store_capacity:
+            return
+        new_parts = max(part_capacity, 1)
+        while new_parts < parts:
+            new_parts *= 2
+        new_stores = max(store_capacity, 1)
+        while new_stores < stores:
+            new_stores *= 2
+
+        available = np.zeros((new_parts, new_stores), dtype=bool)
+        available[:part_capacity, :store_capacity] = self.available
+        inventory = np.zeros((new_parts, new_stores), dtype=np.int32)
+        inventory[:part_capacity, :store_capacity] = self.inventory
+        updated_at = np.full((new_parts, new_stores), np.nan)
+        updated_at[:part_capacity, :store_capacity] = self.updated_at
+        self.available, self.inventory, self.updated_at = available, inventory, updated_at
+        self.part_available_count = np.resize(self.part_available_count, new_parts)
+        self.part_available_count[part_capacity:] = 0
+        self.store_available_count = np.resize(self.store_available_count, new_stores)
+        self.store_available_count[store_capacity:] = 0
+
+    def _part(self, part_number, attributes=None) -> int:
+        index = self.part_index.get(part_number)
+        if index is None:
+            index = len(self.parts)
+            self._grow(index + 1, len(self.stores))
+            self.part_index[part_number] = index
+            self.parts.append(part_number)
+            for name in self.PRODUCT_FIELDS:
+                self.attributes[name].append(None)
+        if attributes:
+            for name in self.PRODUCT_FIELDS:
+                if attributes.get(name) is not None:
+                    self.attributes[name][index] = attributes[name]
+        return index
+
+    def _store(self, store_number) -> int:
+        index = self.store_index.get(store_number)
+        if index is None:
+            index = len(self.stores)
+            self._grow(len(self.parts), index + 1)
+            self.store_index[store_number] = index
+            self.stores.append(store_number)
+        return index
+
+    def _set(self, p, s, is_available, inventory, updated_at):
+        was_available = self.available[p, s]
+        if was_available != is_available:
+            delta = 1 if is_available else -1
+            self.part_available_count[p] += delta
+            self.store_available_count[s] += delta
+        self.available[p, s] = is_available
+        self.inventory[p, s] = inventory
+        self.updated_at[p, s] = updated_at
+
+    def load(self):
+        """ Rebuild the matrix from the latest_availability view """
+        with self._lock:
+            self._reset(*self.available.shape)
+            for product in Product.select():
+                self._part(product.part_number, {name: getattr(product, name) for name in self.PRODUCT_FIELDS})
+            for store in Store.select():
+                self.listed_stores.append(self._store(store.store_number))
+            latest = LatestAvailability.select(
+                LatestAvailability.store_number,
+                LatestAvailability.part_number,
+                LatestAvailability.is_available,
+                LatestAvailability.inventory,
+                LatestAvailability.update_time,
+            ).tuples()
+            for store_number, part_number, is_available, inventory, update_time in latest:
+                self._set(self._part(part_number), self._store(store_number), bool(is_available), inventory or 0,
+                          update_time.timestamp())
+            self.loaded = True
+        logger.info("Availability matrix loaded: %d parts x %d stores", len(self.parts), len(self.stores))
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def update(self, store_number, part_number, is_available, inventory=0, attributes=None):
+        """ Record one observation. `attributes` may give the title / model / capacity / finish of the part """
+        if not self.loaded:
+            return
+        with self._lock:
+            p = self._part(part_number, attributes)
+            s = self._store(store_number)
+            self._set(p, s, bool(is_available), inventory or 0, time.time())
+
+    def set_nearly_unavailable(self, available_parts):
+        """
+        Mark every part except `available_parts` unavailable at the stores of
+        the stores table, like AvailabilityHistory.set_nearly_unavailable
+        """
+        if not self.loaded:
+            return
+        with self._lock:
+            others = np.ones(len(self.parts), dtype=bool)
+            others[[self.part_index[p] for p in available_parts if p in self.part_index]] = False
+            block = np.ix_(np.flatnonzero(others), np.array(self.listed_stores, dtype=np.intp))
+            cleared = self.available[block]
+            self.part_available_count[block[0][:, 0]] -= cleared.sum(axis=1, dtype=np.int32)
+            self.store_available_count[block[1][0]] -= cleared.sum(axis=0, dtype=np.int32)
+            self.available[block] = False
+            self.inventory[block] = 0
+            self.updated_at[block] = time.time()
+
+    def product(self, part_number) -> Product:
+        """ The product as far as it is known here (not saved), for polling without the database """
+        self.ensure_loaded()
+        index = self.part_index.get(part_number)
+        if index is None:
+            return Product(part_number=part_number)
+        with self._lock:
+            return Product(part_number=part_number, **{name: self.attributes[name][index] for name in self.PRODUCT_FIELDS})
+
+    def random_part(self) -> str | None:
+        self.ensure_loaded()
+        with self._lock:
+            return random.choice(self.parts) if self.parts else None
+
+    def oldest_part(self) -> str | None:
+        """ The part of the least recently seen store / part pair, like LatestAvailability.query_oldest """
+        self.ensure_loaded()
+        with self._lock:
+            updated_at = self.updated_at[:len(self.parts), :len(self.stores)]
+            if updated_at.size == 0 or np.isnan(updated_at).all():
+                return None
+            p, _ = np.unravel_index(np.nanargmin(updated_at), updated_at.shape)
+            return self.parts[p]
+
+    def is_part_available(self, part_number) -> bool:
+        """ Is the part available at any store? """
+        self.ensure_loaded()
+        index = self.part_index.get(part_number)
+        return index is not None and bool(self.part_available_count[index] > 0)
+
+    def stores_with_part(self, part_number) -> list[str]:
+        self.ensure_loaded()
+        index = self.part_index.get(part_number)
+        if index is None:
+            return []
+        with self._lock:
+            return [self.stores[s] for s in np.flatnonzero(self.available[index, :len(self.stores)])]
+
+    def parts_in_stock(self, store_number) -> dict[str, int]:
+        """ Part number -> inventory of the parts available at the store """
+        self.ensure_loaded()
+        index = self.store_index.get(store_number)
+        if index is None or not self.store_available_count[index]:
+            return {}
+        with self._lock:
+            column = self.available[:len(self.parts), index]
+            return {self.parts[p]: int(self.inventory[p, index]) for p in np.flatnonzero(column)}
+
+    def aggregate(self, by="model") -> dict[str | None, dict[str, int]]:
+        """
+        Availability grouped by a product attribute (model, capacity or finish):
+        number of parts, parts available somewhere, available store / part pairs
+        and total inventory.
+        """
+        if by not in self.ATTRIBUTES:
+            raise ValueError(f"Cannot aggregate by {by!r}, choose from {self.ATTRIBUTES}")
+        self.ensure_loaded()
+        with self._lock:
+            n_parts, n_stores = len(self.parts), len(self.stores)
+            if not n_parts:
+                return {}
+            values = np.array([v if v is not None else "" for v in self.attributes[by]])
+            groups, group_of_part = np.unique(values, return_inverse=True)
+            available_pairs = self.part_available_count[:n_parts]
+            inventory = self.inventory[:n_parts, :n_stores].sum(axis=1)
+
+            parts = np.bincount(group_of_part, minlength=len(groups))
+            parts_available = np.bincount(group_of_part, weights=available_pairs > 0, minlength=len(groups))
+            pairs = np.bincount(group_of_part, weights=available_pairs, minlength=len(groups))
+            total_inventory = np.bincount(group_of_part, weights=inventory, minlength=len(groups))
+
+        return {
+            (str(group) or None): dict(
+                parts=int(parts[g]),
+                parts_available=int(parts_available[g]),
+                available_pairs=int(pairs[g]),
+                inventory=int(total_inventory[g]),
+            )
+            for g, group in enumerate(groups)
+        }
+
+
+availability_matrix = AvailabilityMatrix()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the latest availability from memory.")
+    parser.add_argument("--part", help="Part number: stores where it is available.")
+    parser.add_argument("--store", help="Store number: parts in stock.")
+    parser.add_argument("--by", choices=AvailabilityMatrix.ATTRIBUTES, help="Aggregate by product attribute.")
+    args = parser.parse_args()
+
+    if args.part:
+        print(availability_matrix.stores_with_part(args.part))
+    if args.store:
+        print(availability_matrix.parts_in_stock(args.store))
+    if args.by:
+        for group, counts in availability_matrix.aggregate(args.by).items():
+            print(group, counts)
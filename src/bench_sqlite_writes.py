@@ -0,0 +1,107 @@
+"""
+Benchmark the sustained AvailabilityHistory write rate on SQLite under
+parallel fetch workers.
+
+Each worker thread plays a fetch worker: it keeps producing observations for
+random store / part pairs and persists them the way check_availability does.
+With the `default` profile every worker writes directly; with the `throughput`
+profile observations go through the single write-behind thread.
+
+    python bench_sqlite_writes.py --workers 8 --seconds 10
+
+Without --profile, both profiles are run (each in its own process, since the
+database is configured at import time).
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PROFILES = ("default", "throughput")
+
+
+def run_profile(args):
+    db_dir = tempfile.mkdtemp()
+    os.environ["APP_DB_PATH"] = os.path.join(db_dir, "bench.db")
+    os.environ["APP_DB_SQLITE_PROFILE"] = args.profile
+    os.environ["APP_WRITE_BEHIND_JOURNAL"] = os.path.join(db_dir, "bench.journal")
+    os.environ.setdefault("APP_LOG_LEVEL", "WARNING")
+    # keep the backlog small, so the run measures the sustained rate rather than queueing
+    os.environ.setdefault("APP_WRITE_BEHIND_MAX_PENDING", "1000")
+
+    from peewee import OperationalError
+
+    from models import Store, AvailabilityHistory
+    from fixtures import load_store_numbers
+    from write_behind import write_behind_queue
+
+    store_numbers = load_store_numbers()
+    for store_number in store_numbers:
+        Store.create(store_number=store_number, name=store_number, country="HK", city="香港", address=store_number)
+    part_numbers = [f"BENCH{i:03}/A" for i in range(args.parts)]
+
+    stop = threading.Event()
+    produced = [0] * args.workers
+    errors = [0] * args.workers
+
+    def worker(n):
+        rng = random.Random(n)
+        while not stop.is_set():
+            store_number = rng.choice(store_numbers)
+            part_number = rng.choice(part_numbers)
+            is_available = rng.random() < 0.2
+            try:
+                if write_behind_queue:
+                    write_behind_queue.set_availability(store_number, part_number, is_available)
+                else:
+                    AvailabilityHistory.set_availability(store_number, part_number, is_available)
+                produced[n] += 1
+            except OperationalError:
+                # "database is locked"
+                errors[n] += 1
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.workers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    if write_behind_queue:
+        write_behind_queue.flush()
+    elapsed = time.perf_counter() - start
+
+    print(json.dumps(dict(
+        profile=args.profile,
+        workers=args.workers,
+        seconds=round(elapsed, 2),
+        observations=sum(produced),
+        errors=sum(errors),
+        history_rows=AvailabilityHistory.select().count(),
+        observations_per_second=round(sum(produced) / elapsed, 1),
+    )))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark AvailabilityHistory writes on SQLite.")
+    parser.add_argument("--profile", choices=PROFILES, help="SQLite profile; runs all profiles if omitted.")
+    parser.add_argument("--workers", type=int, default=8, help="Number of parallel fetch workers.")
+    parser.add_argument("--seconds", type=float, default=10, help="Duration of the run.")
+    parser.add_argument("--parts", type=int, default=50, help="Number of distinct part numbers.")
+    args = parser.parse_args()
+
+    if args.profile:
+        run_profile(args)
+    else:
+        for profile in PROFILES:
+            subprocess.run(
+                [sys.executable, __file__, "--profile", profile, "--workers", str(args.workers),
+                 "--seconds", str(args.seconds), "--parts", str(args.parts)],
+                check=True,
+            )
@@ -0,0 +1,253 @@
+"""
+Benchmark the HTTP transports against a local stub of the Apple Store API.
+
+The stub answers every request with a fulfillment-messages payload for the
+stores in fixture.yml, after a configurable latency (Apple takes a while to
+answer). It is served twice: over HTTP/1.1 for the `requests` transport, and
+over cleartext HTTP/2 (h2c) for the `http2` transport.
+
+Both transports get the same concurrency, `--batch-size` requests at a time:
+the http2 transport multiplexes them over one connection, while the requests
+transport sends them from as many threads over its pooled session (one
+connection each). So the difference measures the protocol, not concurrency.
+
+    python bench_transport.py --requests 200 --latency 50
+"""
+import argparse
+import gzip
+import json
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests.adapters
+import h2.config
+import h2.connection
+import h2.events
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from fixtures import load_store_numbers
+from transport import RequestsTransport, Http2Transport
+
+
+PART_NUMBERS = ("MYLV3ZA/A", "MYLU3ZA/A", "MYLN3ZA/A")
+
+
+def build_payload() -> bytes:
+    stores = []
+    for store_number in load_store_numbers():
+        stores.append({
+            "storeNumber": store_number,
+            "storeName": f"Store {store_number}",
+            "partsAvailability": {
+                part_number: {
+                    "pickupDisplay": "unavailable",
+                    "pickupSearchQuote": "暫無供應",
+                    "buyability": {"isBuyable": False, "inventory": 0},
+                    "messageTypes": {
+                        "regular": {
+                            "storePickupProductTitle": "iPhone 16 Pro 256GB 沙漠色鈦金屬",
+                            "storePickupQuote": "今日暫無供應",
+                        },
+                    },
+                }
+                for part_number in PART_NUMBERS
+            },
+        })
+    data = {"head": {"status": "200"}, "body": {"content": {"pickupMessage": {"stores": stores}}}}
+    return json.dumps(data, ensure_ascii=False).encode()
+
+
+def encode_body(body: bytes, accept_encoding: str) -> tuple[bytes, str | None]:
+    accepted = {e.split(";")[0].strip() for e in accept_encoding.split(",")}
+    if brotli is not None and "br" in accepted:
+        return brotli.compress(body), "br"
+    if "gzip" in accepted:
+        return gzip.compress(body), "gzip"
+    return body, None
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        body, encoding = encode_body(self.server.payload, self.headers.get("Accept-Encoding", ""))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_http1(payload, latency):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.payload = payload
+    server.latency = latency
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
+
+
+class H2StubConnection:
+    """ One h2c connection of the stub: answers each stream after `latency` """
+    def __init__(self, sock, payload, latency):
+        self.sock = sock
+        self.payload = payload
+        self.latency = latency
+        self.conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False))
+        self.lock = threading.Lock()
+        self.pending = {}  # stream_id -> body not yet sent because of flow control
+        self.timers = ThreadPoolExecutor(max_workers=32)
+
+    def flush(self):
+        data = self.conn.data_to_send()
+        if data:
+            self.sock.sendall(data)
+
+    def respond(self, stream_id, accept_encoding):
+        time.sleep(self.latency)
+        body, encoding = encode_body(self.payload, accept_encoding)
+        headers = [(":status", "200"), ("content-type", "application/json"), ("content-length", str(len(body)))]
+        if encoding:
+            headers.append(("content-encoding", encoding))
+        with self.lock:
+            self.conn.send_headers(stream_id, headers)
+            self.pending[stream_id] = body
+            self.send_pending()
+            self.flush()
+
+    def send_pending(self):
+        for stream_id, body in list(self.pending.items()):
+            window = self.conn.local_flow_control_window(stream_id)
+            size = min(window, self.conn.max_outbound_frame_size, len(body))
+            while size > 0:
+                self.conn.send_data(stream_id, body[:size])
+                body = body[size:]
+                window = self.conn.local_flow_control_window(stream_id)
+                size = min(window, self.conn.max_outbound_frame_size, len(body))
+            if body:
+                self.pending[stream_id] = body
+            else:
+                self.conn.end_stream(stream_id)
+                del self.pending[stream_id]
+
+    def run(self):
+        with self.lock:
+            self.conn.initiate_connection()
+            self.flush()
+        while True:
+            data = self.sock.recv(65535)
+            if not data:
+                break
+            with self.lock:
+                events = self.conn.receive_data(data)
+                for event in events:
+                    if isinstance(event, h2.events.RequestReceived):
+                        headers = {k.decode() if isinstance(k, bytes) else k: v.decode() if isinstance(v, bytes) else v
+                                   for k, v in event.headers}
+                        self.timers.submit(self.respond, event.stream_id, headers.get("accept-encoding", ""))
+                    elif isinstance(event, h2.events.WindowUpdated):
+                        self.send_pending()
+                self.flush()
+        self.timers.shutdown(wait=False)
+        self.sock.close()
+
+
+def serve_h2c(payload, latency):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen()
+
+    def accept_loop():
+        while True:
+            client, _ = sock.accept()
+            connection = H2StubConnection(client, payload, latency)
+            threading.Thread(target=connection.run, daemon=True).start()
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+    return sock, sock.getsockname()[1]
+
+
+def threaded_get_many(transport, urls):
+    """ Send urls concurrently from threads, each request on its own pooled connection """
+    def get_or_error(url):
+        try:
+            return transport.get(url)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        return list(executor.map(get_or_error, urls))
+
+
+def run_benchmark(transport, url, count, batch_size):
+    # the http2 transport multiplexes a batch itself; the requests transport would send it one by one
+    get_many = transport.get_many if isinstance(transport, Http2Transport) else \
+        lambda batch: threaded_get_many(transport, batch)
+    urls = [f"{url}?pl=true&parts.0={PART_NUMBERS[i % len(PART_NUMBERS)]}" for i in range(count)]
+    wire_bytes = 0
+    body_bytes = 0
+    failed = 0
+    versions = set()
+
+    start = time.perf_counter()
+    for i in range(0, count, batch_size):
+        for response in get_many(urls[i:i + batch_size]):
+            if isinstance(response, Exception) or response.status_code != 200:
+                failed += 1
+                continue
+            wire_bytes += response.wire_bytes
+            body_bytes += len(response.content)
+            versions.add(response.http_version)
+    elapsed = time.perf_counter() - start
+
+    return dict(
+        transport=transport.name,
+        http_version=",".join(sorted(versions)),
+        requests=count,
+        failed=failed,
+        seconds=round(elapsed, 3),
+        requests_per_second=round(count / elapsed, 1),
+        wire_bytes=wire_bytes,
+        body_bytes=body_bytes,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare HTTP transports against a local stub server.")
+    parser.add_argument("--requests", type=int, default=100, help="Number of requests per transport.")
+    parser.add_argument("--batch-size", type=int, default=8, help="Requests sent together with get_many.")
+    parser.add_argument("--latency", type=float, default=50, help="Stub server latency in milliseconds.")
+    args = parser.parse_args()
+
+    payload = build_payload()
+    latency = args.latency / 1000
+    _, http1_port = serve_http1(payload, latency)
+    _, h2c_port = serve_h2c(payload, latency)
+
+    print(f"payload: {len(payload)} bytes, latency: {args.latency}ms, brotli: {brotli is not None}")
+
+    requests_transport = RequestsTransport()
+    # enough pooled connections for a batch
+    requests_transport.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=args.batch_size))
+    benchmarks = (
+        (requests_transport, f"http://127.0.0.1:{http1_port}/fulfillment-messages"),
+        (Http2Transport(max_streams=args.batch_size, prior_knowledge=True), f"http://127.0.0.1:{h2c_port}/fulfillment-messages"),
+    )
+    for transport, url in benchmarks:
+        result = run_benchmark(transport, url, args.requests, args.batch_size)
+        transport.close()
+        print(json.dumps(result))
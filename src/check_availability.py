@@ -1,16 +1,27 @@
 import argparse
 import json
-import requests
+import os
 import random
 import time
 from datetime import datetime, timezone
+from pathlib import Path
 from urllib.parse import urlparse, parse_qs
 
-from models import AvailabilityHistory, Product, LatestAvailability
-from common import logger
+from models import AvailabilityHistory, Product, LatestAvailability, Transition
+from api_helpers import try_parse_product_details, parse_inventory_from_product_details
+from availability_matrix import availability_matrix
+from common import logger, poll_stats
+from fetch_cache import fetch_cache
 from notify import send_text
+from subscriptions import notify_subscribers
+from write_behind import write_behind_queue
 
 
+SWEEP_BATCH_SIZE = int(os.environ.get('APP_SWEEP_BATCH_SIZE', 10))  # parts per fulfillment request
+SWEEP_CONCURRENCY = int(os.environ.get('APP_SWEEP_CONCURRENCY', 4))  # requests sent together
+SWEEP_MAX_REQUESTS = int(os.environ.get('APP_SWEEP_MAX_REQUESTS', 50))  # per sweep, 0 for no limit
+SWEEP_CURSOR = os.environ.get('APP_SWEEP_CURSOR', 'sweep.cursor')  # where the next capped sweep resumes
+
 models = {
     "desert-256g": "MYLV3ZA/A",
     # "desert-512g": "MYM23ZA/A",
@@ -31,7 +42,7 @@ apple_store_urls = {
         "base_url": "https://www.apple.com/hk-zh/shop/",
         "endpoint": "fulfillment-messages",
         "query": {},
-        "format": "https://www.apple.com/hk-zh/shop/fulfillment-messages?pl=true&mts.0=regular&mts.1=compact&cppart=UNLOCKED/WW&parts.0={part_number}&location=%E9%A6%99%E6%B8%AF",
+        "format": "https://www.apple.com/hk-zh/shop/fulfillment-messages?pl=true&mts.0=regular&mts.1=compact&cppart=UNLOCKED/WW&{parts}&location=%E9%A6%99%E6%B8%AF",
     }
 }
 
@@ -40,12 +51,67 @@ recommendations_url = apple_store_urls["pickup-message-recommendations"]["decode
 fulfillment_url = apple_store_urls["fulfillment-messages"]["encoded"]
 
 
-session = None
-
-
-def check_fulfillment_availability(data) -> list[str]:
+def store_availability(store_number, part_number, is_available, product_details=None):
+    """
+    Persist one observation, in the background if write-behind is enabled
+    (its transitions are then notified by the writer).
+    The in-memory availability matrix, if the scheduler loaded it, is updated right away.
+    """
+    availability_matrix.update(
+        store_number,
+        part_number,
+        is_available,
+        inventory=parse_inventory_from_product_details(product_details) or 0,
+        attributes=try_parse_product_details(product_details),
+    )
+    if write_behind_queue:
+        write_behind_queue.set_availability(store_number, part_number, is_available, product_details)
+        return None
+    return AvailabilityHistory.set_availability(store_number, part_number, is_available, product_details)
+
+
+def store_availability_many(observations) -> list[Transition]:
+    """ store_availability for many (store_number, part_number, is_available, product_details), in bulk """
+    for store_number, part_number, is_available, details in observations:
+        availability_matrix.update(
+            store_number,
+            part_number,
+            is_available,
+            inventory=parse_inventory_from_product_details(details) or 0,
+            attributes=try_parse_product_details(details),
+        )
+    if write_behind_queue:
+        write_behind_queue.set_availability_many(observations)
+        return []
+    return AvailabilityHistory.set_availability_many(observations)
+
+
+def store_nearly_unavailable(available_products):
+    availability_matrix.set_nearly_unavailable(available_products)
+    if write_behind_queue:
+        write_behind_queue.set_nearly_unavailable(available_products)
+        return []
+    return AvailabilityHistory.set_nearly_unavailable(available_products)
+
+
+def parse_fulfillment_observations(data) -> list[tuple[str, str, bool, dict]]:
+    """ (store_number, part_number, is_available, product_details) of every store x part of a fulfillment response """
+    data = json.loads(data)
+    return [
+        (store["storeNumber"], part_number, details["pickupDisplay"] == "available", details)
+        for store in data['body']['content']['pickupMessage']['stores']
+        for part_number, details in store['partsAvailability'].items()
+    ]
+
+
+def store_fulfillment_availability(data, persist=True) -> tuple[list[str], list[Transition]]:
+    """
+    Store every store x part of a fulfillment response; returns the available stores and the transitions.
+    With `persist` False (a response already stored), only the available stores are returned.
+    """
     data = json.loads(data)
     available_stores = []
+    transitions = []
 
     # Iterate through the stores
     for store in data['body']['content']['pickupMessage']['stores']:
@@ -55,13 +121,24 @@ def check_fulfillment_availability(data) -> list[str]:
             is_available = details["pickupDisplay"] == "available"
             if is_available:
                 available_stores.append(store['storeName'])  # Save the store's name
+            if not persist:
+                continue
 
-            AvailabilityHistory.set_availability(
+            transition = store_availability(
                 store["storeNumber"],
                 part_number,
                 is_available,
                 product_details=details
             )
+            if transition:
+                transitions.append(transition)
+
+    return available_stores, transitions
+
+
+def check_fulfillment_availability(data, persist=True) -> list[str]:
+    available_stores, transitions = store_fulfillment_availability(data, persist)
+    notify_subscribers(transitions)
 
     # Check if more than one store is available
     if available_stores:
@@ -72,22 +149,29 @@ def check_fulfillment_availability(data) -> list[str]:
     return available_stores
 
 
-def check_recommendations_availability(data) -> list[str]:
+def check_recommendations_availability(data, persist=True) -> list[str]:
     data = json.loads(data)
     recommended_products = set()
+    transitions = []
 
     for store in data['body']['PickupMessage']['stores']:
         # Check if partsAvailability is not empty
         parts_availability = store['partsAvailability']
 
         for part_number, details in parts_availability.items():
-            AvailabilityHistory.set_availability(
+            recommended_products.add(part_number)
+            if not persist:
+                continue
+            transition = store_availability(
                 store["storeNumber"],
                 part_number,
                 True,
                 product_details=details
             )
-            recommended_products.add(part_number)
+            if transition:
+                transitions.append(transition)
+
+    notify_subscribers(transitions)
 
     # Check if more than one store is available
     if recommended_products:
@@ -98,83 +182,115 @@ def check_recommendations_availability(data) -> list[str]:
     return recommended_products
 
 
-def request_fulfillment(product, cookie_jar=None, update_cookie_jar=False, har_save_path=None) -> list[str]:
+def fulfillment_request_url(*part_numbers) -> str:
+    """ One request can ask for several parts: parts.0, parts.1, ... """
     url_template = apple_store_urls["fulfillment-messages"]["format"]
-    url = url_template.format(part_number=product)
+    parts = "&".join(f"parts.{i}={part_number}" for i, part_number in enumerate(part_numbers))
+    return url_template.format(parts=parts)
 
-    logger.info(f"Requesting fulfillment for {product}")
-    logger.debug(url)
 
-    # Step 1: Create a session and load cookies if provided
-    session = requests.Session()
-    if cookie_jar:
-        with open(cookie_jar, 'r') as f:
-            cookies = json.load(f)
-            session.cookies.update(cookies)
+def recommendations_request_url(product) -> str:
+    url_template = apple_store_urls["pickup-message-recommendations"]["format"]
+    return url_template.format(product=product)
 
-    # Step 2: Send HTTP request
-    response = session.get(url)
 
-    # Step 3: Parse response
-    if response.status_code != 200:
+def parse_fulfillment_response(response) -> list[str]:
+    if response is None or response.status_code != 200:
         print("failed")
         return
 
-    # Update cookie jar if requested
-    if update_cookie_jar and cookie_jar:
-        with open(cookie_jar, 'w') as f:
-            json.dump(session.cookies.get_dict(), f)
+    # a response from the fetch cache was stored when it was fetched
+    return check_fulfillment_availability(response.content.decode(), persist=not response.from_cache)
 
-    return check_fulfillment_availability(response.content.decode())
 
+def parse_recommendations_response(response) -> set[str]:
+    if response is None or response.status_code != 200:
+        print("failed")
+        return
+
+    return check_recommendations_availability(response.content.decode(), persist=not response.from_cache)
 
-def request_recommendations(product, cookie_jar=None, update_cookie_jar=False, har_save_path=None) -> list[str]:
-    url_template = apple_store_urls["pickup-message-recommendations"]["format"]
 
+def request_fulfillment(product, cookie_jar=None, update_cookie_jar=False, har_save_path=None) -> list[str]:
+    url = fulfillment_request_url(product)
+
+    logger.info("Requesting fulfillment for %s", product)
+    logger.debug(url)
+
+    # Step 1: Send HTTP request through the egress pool
+    #         (each route keeps its own transport and cookies),
+    #         unless the same request was just sent
+    response = fetch_cache.get(url, cookie_jar=cookie_jar, update_cookie_jar=update_cookie_jar)
+
+    # Step 2: Parse response
+    return parse_fulfillment_response(response)
+
+
+def request_fulfillment_many(products) -> list[list[str]]:
+    """
+    Request fulfillment for several products at once.
+    With the http2 transport, the requests are multiplexed over one connection.
+    """
+    products = list(products)
+    logger.info("Requesting fulfillment for %s", products)
+
+    responses = fetch_cache.get_many([fulfillment_request_url(p) for p in products])
+    return [parse_fulfillment_response(response) for response in responses]
+
+
+def request_recommendations(product, cookie_jar=None, update_cookie_jar=False, har_save_path=None) -> set[str]:
     if product is None:
         for part_number in models.values():
             request_recommendations(product=part_number)
         return
 
-    url = url_template.format(product=product)
+    url = recommendations_request_url(product)
 
     print(url)
 
-    # Step 1: Create a session and load cookies if provided
-    session = requests.Session()
-    if cookie_jar:
-        with open(cookie_jar, 'r') as f:
-            cookies = json.load(f)
-            session.cookies.update(cookies)
+    # Step 1: Send HTTP request through the egress pool
+    #         (each route keeps its own transport and cookies),
+    #         unless the same request was just sent
+    response = fetch_cache.get(url, cookie_jar=cookie_jar, update_cookie_jar=update_cookie_jar)
 
-    # Step 2: Send HTTP request
-    response = session.get(url)
+    # Step 2: Parse response
+    return parse_recommendations_response(response)
 
-    # Step 3: Parse response
-    if response.status_code != 200:
-        print("failed")
-        return
 
-    # Update cookie jar if requested
-    if update_cookie_jar and cookie_jar:
-        with open(cookie_jar, 'w') as f:
-            json.dump(session.cookies.get_dict(), f)
+def polls_without_db() -> bool:
+    """
+    With write-behind, polling goes on while the database is unavailable: the
+    products to poll are then picked from the availability matrix (loaded by
+    the scheduler) instead of the database.
+    """
+    return bool(write_behind_queue) and availability_matrix.loaded
 
-    return check_recommendations_availability(response.content.decode())
+
+def find_product(part_number) -> Product:
+    if polls_without_db():
+        return availability_matrix.product(part_number)
+    return Product.get(Product.part_number == part_number)
 
 
 def check_product_availability(product: Product | str, recursive=False) -> tuple[bool, bool]:
     if isinstance(product, str):
-        product: Product = Product.get(Product.part_number == product)
-    prev_availability = LatestAvailability.is_product_available(product)
+        product: Product = find_product(product)
+    if availability_matrix.loaded:
+        # kept in memory by the scheduler
+        prev_availability = availability_matrix.is_part_available(product.part_number)
+    else:
+        prev_availability = LatestAvailability.is_product_available(product)
 
-    time.sleep(0.1)
-    available_stores = bool(request_fulfillment(product.part_number))
-    time.sleep(0.1)
-    recommended_products = request_recommendations(product.part_number)
+    # fulfillment and recommendations are independent, send them together
+    fulfillment_response, recommendations_response = fetch_cache.get_many([
+        fulfillment_request_url(product.part_number),
+        recommendations_request_url(product.part_number),
+    ])
+    available_stores = bool(parse_fulfillment_response(fulfillment_response))
+    recommended_products = parse_recommendations_response(recommendations_response) or set()
 
     if prev_availability != bool(available_stores):
-        logger.info(f"Availability of {product.part_number} ({product.product_title}) changed!")
+        logger.info("Availability of %s (%s) changed!", product.part_number, product.product_title)
         # send notification
         if available_stores:
             send_text(f"Congratulations! {product.part_number} {product.capacity}-{product.finish} is available.")
@@ -183,15 +299,16 @@ def check_product_availability(product: Product | str, recursive=False) -> tuple
 
     if len(recommended_products) < 3:
         # update availability for recommended_products
-        for p in recommended_products:
-            time.sleep(0.1)
-            request_fulfillment(p)
+        if recommended_products:
+            request_fulfillment_many(recommended_products)
 
         # update all other products to not available
+        # (unless these recommendations came from the fetch cache: that was done when they were fetched)
         all_available_products = recommended_products.copy()
         if available_stores:
             all_available_products.add(product.part_number)
-        AvailabilityHistory.set_nearly_unavailable(all_available_products)
+        if not (recommendations_response and recommendations_response.from_cache):
+            notify_subscribers(store_nearly_unavailable(all_available_products))
 
     if not recursive or len(recommended_products) < 3:
         return (available_stores, recommended_products)
@@ -202,31 +319,122 @@ def check_product_availability(product: Product | str, recursive=False) -> tuple
     return None, None
 
 
-def check_availability(product=None, pick_mode=None, recursive=False):
+def load_sweep_cursor(key, path=SWEEP_CURSOR) -> int:
+    """ Id of the last product checked by the last capped sweep of `key` (0 if none) """
+    try:
+        return json.loads(Path(path).read_text()).get(key, 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def save_sweep_cursor(key, product_id, path=SWEEP_CURSOR):
+    path = Path(path)
+    try:
+        cursors = json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        cursors = {}
+    cursors[key] = product_id
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(json.dumps(cursors))
+    os.replace(tmp_path, path)
+
+
+def sweep_products(model=None, capacity=None, finish=None, batch_size=SWEEP_BATCH_SIZE,
+                   concurrency=SWEEP_CONCURRENCY, max_requests=SWEEP_MAX_REQUESTS, cursor_path=SWEEP_CURSOR) -> dict:
+    """
+    Check every product of the catalog (optionally only a model / capacity / finish).
+
+    Parts are requested `batch_size` per fulfillment request, `concurrency`
+    requests at a time through the egress pool, which holds them to its
+    request budget. The observations of each round are written in bulk
+    (or handed to the write-behind queue as one item). At most
+    `max_requests` are sent, so a sweep has a bounded cost; a capped sweep
+    resumes after the last product of the previous one (the cursor is kept
+    in `cursor_path`), so repeated sweeps cover the whole catalog.
+    """
+    products = Product.select_matching(model, capacity, finish)
+    cursor_key = "/".join(value or "*" for value in (model, capacity, finish))
+    capped = max_requests and len(products) > max_requests * batch_size
+    if capped:
+        last_id = load_sweep_cursor(cursor_key, cursor_path)
+        start = next((i for i, product in enumerate(products) if product.id > last_id), 0)
+        products = (products[start:] + products[:start])[:max_requests * batch_size]
+        logger.info("Sweep is limited to %d requests, resuming after product id %d", max_requests, last_id)
+    part_numbers = [p.part_number for p in products]
+    batches = [part_numbers[i:i + batch_size] for i in range(0, len(part_numbers), batch_size)]
+
+    logger.info("Sweeping %d parts in %d requests", sum(len(batch) for batch in batches), len(batches))
+    started = time.monotonic()
+    swept, failed = 0, 0
+    for i in range(0, len(batches), concurrency):
+        round_batches = batches[i:i + concurrency]
+        responses = fetch_cache.get_many([fulfillment_request_url(*batch) for batch in round_batches])
+
+        observations = []
+        for batch, response in zip(round_batches, responses):
+            if response is None or response.status_code != 200:
+                failed += len(batch)
+                continue
+            swept += len(batch)
+            # a response from the fetch cache was stored when it was fetched
+            if not response.from_cache:
+                observations.extend(parse_fulfillment_observations(response.content.decode()))
+        notify_subscribers(store_availability_many(observations))
+
+    if capped:
+        save_sweep_cursor(cursor_key, products[-1].id, cursor_path)
+    elapsed = time.monotonic() - started
+    poll_stats.add("parts_swept", swept)
+    poll_stats.add("parts_failed", failed)
+    logger.info("Swept %d parts (%d failed) in %.1fs, %.1f parts/s",
+                swept, failed, elapsed, swept / elapsed if elapsed else 0)
+    return dict(parts=swept, failed=failed, requests=len(batches), seconds=elapsed,
+                parts_per_second=swept / elapsed if elapsed else 0)
+
+
+def check_availability(product=None, pick_mode=None, recursive=False, filters=None):
+    """ `filters` (model, capacity, finish) select the products of a sweep """
+    poll_stats.start()
+    try:
+        _check_availability(product, pick_mode, recursive, filters)
+    finally:
+        poll_stats.log_summary(logger, product or pick_mode)
+
+
+def _check_availability(product=None, pick_mode=None, recursive=False, filters=None):
 
     if product:
         check_product_availability(product, recursive)
     elif pick_mode == "random":
         # Randomly select a known product
-        product_count = Product.select().count()
-        random_offset = random.randrange(product_count)
-        logger.debug(f"random product offset {random_offset} from {product_count} products")
-        product: Product = Product.select().offset(random_offset).first()
-        logger.info(f"Checking availability for {product.part_number} ({product.product_title})")
+        if polls_without_db():
+            product: Product = availability_matrix.product(availability_matrix.random_part())
+        else:
+            product_count = Product.select().count()
+            random_offset = random.randrange(product_count)
+            logger.debug("random product offset %d from %d products", random_offset, product_count)
+            product: Product = Product.select().offset(random_offset).first()
+        logger.info("Checking availability for %s (%s)", product.part_number, product.product_title)
         check_product_availability(product, recursive)
     elif pick_mode == "oldest":
         # Select the (roughly) least recently updated product
         # Note: here we simply select the oldest updated record, but this product at other store
         # could have been updated more recently
-        oldest_updated = LatestAvailability.select().order_by(LatestAvailability.update_time).first()
-        product: Product = Product.select().where(Product.part_number == oldest_updated.part_number).first()
-        logger.info(f"Checking availability for {product.part_number} ({product.product_title})")
+        if polls_without_db():
+            product: Product = availability_matrix.product(availability_matrix.oldest_part())
+        else:
+            oldest_updated = LatestAvailability.query_oldest().first()
+            product: Product = Product.select().where(Product.part_number == oldest_updated.part_number).first()
+        logger.info("Checking availability for %s (%s)", product.part_number, product.product_title)
         check_product_availability(product, recursive)
     elif pick_mode == "all":
         for part_number in models.values():
             check_product_availability(part_number, recursive)
             time.sleep(3 + random.uniform(0.1, 2.5))
         return
+    elif pick_mode == "sweep":
+        # The whole catalog, as far as it is known from recommendations
+        sweep_products(**(filters or {}))
     else:
         logger.warning("No product is checked.")
 
@@ -237,6 +445,10 @@ if __name__ == "__main__":
     parser.add_argument("--random", action="store_true", help="Check availability for a random product.")
     parser.add_argument("--oldest", action="store_true", help="Check availability for the least recently updated product.")
     parser.add_argument("--check-all", action="store_true", help="Check availability for all products.")
+    parser.add_argument("--sweep", action="store_true", help="Check availability for every product in the database.")
+    parser.add_argument("--model", help="Only sweep this model, e.g. \"iPhone 16 Pro\".")
+    parser.add_argument("--capacity", help="Only sweep this capacity, e.g. 256GB.")
+    parser.add_argument("--finish", help="Only sweep this finish.")
     parser.add_argument("-r", "--recursive", action="store_true", help="Recursively check availability if recommendations are available.")
     parser.add_argument("--url", help="URL to send the request to.", default=recommendations_url)
     parser.add_argument("--har-save-path", type=str, help="File path to save HAR to.")
@@ -253,5 +465,8 @@ if __name__ == "__main__":
         pick_mode = "oldest"
     elif args.check_all:
         pick_mode = "all"
+    elif args.sweep:
+        pick_mode = "sweep"
 
-    check_availability(args.product, pick_mode, args.recursive)
+    filters = dict(model=args.model, capacity=args.capacity, finish=args.finish)
+    check_availability(args.product, pick_mode, args.recursive, filters)
@@ -0,0 +1,138 @@
+"""
+Check the egress pool against local proxy stand-ins.
+
+Each stand-in is a local HTTP proxy that answers requests itself (with a
+configurable status) instead of forwarding them, and counts what it got, so
+the pool's routing, retries and quarantines can be exercised without
+touching Apple.
+
+    python check_egress.py
+
+Exits with code 1 if a check fails.
+"""
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from egress import EgressPool
+
+TARGET_URL = "http://www.apple.com.invalid/hk-zh/shop/fulfillment-messages?parts.0=MYLV3ZA/A"
+
+
+class ProxyStandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.received.append(self.path)
+        body = b"{}"
+        self.send_response(self.server.status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_proxy(status=200):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ProxyStandInHandler)
+    server.status = status
+    server.received = []
+    server.lock = threading.Lock()
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def check_spread_over_routes():
+    (a, a_url), (b, b_url) = serve_proxy(), serve_proxy()
+    pool = EgressPool.from_specs([a_url, b_url], budget=10, window=60)
+    responses = [pool.get(TARGET_URL) for _ in range(6)]
+    problems = []
+    if any(r is None or r.status_code != 200 for r in responses):
+        problems.append("some requests failed")
+    if not a.received or not b.received:
+        problems.append(f"requests not spread: {len(a.received)} / {len(b.received)}")
+    if a.received and not a.received[0].startswith("http://www.apple.com.invalid/"):
+        problems.append(f"proxy got {a.received[0]!r} instead of the target URL")
+    return problems
+
+
+def check_retry_and_quarantine():
+    (throttled, throttled_url), (ok, ok_url) = serve_proxy(status=429), serve_proxy()
+    pool = EgressPool.from_specs([throttled_url, ok_url], budget=10, window=60, max_failures=2, quarantine=60)
+    problems = []
+    for _ in range(4):
+        response = pool.get(TARGET_URL)
+        if response is None or response.status_code != 200:
+            problems.append("a throttled request was not retried on the other route")
+            break
+    count = len(throttled.received)
+    pool.get(TARGET_URL)
+    if len(throttled.received) != count:
+        problems.append("the throttled route was not quarantined")
+    return problems
+
+
+def check_quarantined_pool_does_not_wait():
+    _, throttled_url = serve_proxy(status=429)
+    pool = EgressPool.from_specs([throttled_url], budget=10, window=60, max_failures=1, quarantine=300)
+    pool.get(TARGET_URL)  # quarantines the only route
+    start = time.monotonic()
+    response = pool.get(TARGET_URL)
+    elapsed = time.monotonic() - start
+    problems = []
+    if response is not None:
+        problems.append("a request went through a quarantined route")
+    if elapsed > 1:
+        problems.append(f"waited {elapsed:.1f}s for a quarantined route")
+    return problems
+
+
+def check_batch_larger_than_budget():
+    _, proxy_url = serve_proxy()
+    pool = EgressPool.from_specs([proxy_url], budget=2, window=0.5)
+    result = []
+    thread = threading.Thread(target=lambda: result.extend(pool.get_many([TARGET_URL] * 3)), daemon=True)
+    thread.start()
+    thread.join(timeout=5)
+    if thread.is_alive():
+        return ["get_many of 3 requests on a budget of 2 did not finish"]
+    if len(result) != 3 or any(r is None for r in result):
+        return [f"expected 3 responses, got {result}"]
+    return []
+
+
+def check_get_many_retries_on_another_route():
+    (throttled, throttled_url), (ok, ok_url) = serve_proxy(status=429), serve_proxy()
+    pool = EgressPool.from_specs([throttled_url, ok_url], budget=10, window=60, max_failures=10)
+    responses = pool.get_many([TARGET_URL] * 4)
+    problems = []
+    if not throttled.received:
+        problems.append("no request went through the throttled route")
+    if any(r is None or r.status_code != 200 for r in responses):
+        problems.append(f"throttled requests were not retried on the other route: {responses}")
+    return problems
+
+
+checks = {
+    "requests are spread over the routes": check_spread_over_routes,
+    "throttled requests are retried, and the route quarantined": check_retry_and_quarantine,
+    "a quarantined pool returns None without waiting": check_quarantined_pool_does_not_wait,
+    "get_many of more requests than the budget": check_batch_larger_than_budget,
+    "get_many retries throttled requests on another route": check_get_many_retries_on_another_route,
+}
+
+
+if __name__ == "__main__":
+    failed = False
+    for name, check in checks.items():
+        problems = check()
+        print(f"{'FAIL' if problems else 'ok'}  {name}")
+        for problem in problems:
+            print(f"    ! {problem}")
+        failed = failed or bool(problems)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,219 @@
+"""
+Guardrail for the query plans of the hot queries.
+
+Loads a realistic amount of availability history into a scratch database,
+runs EXPLAIN on each hot query, and fails (exit code 1) if one of them reads
+availability_history with a sequential scan or sorts the full history.
+
+    python check_query_plans.py               # SQLite, in a temporary file
+    python check_query_plans.py --postgres    # PostgreSQL configured by APP_DB_*
+
+On PostgreSQL the data is loaded into a scratch schema (dropped afterwards),
+so the tables of the configured database are not touched.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+HISTORY_TABLE = "availability_history"
+SCRATCH_SCHEMA = "query_plan_check"
+
+# a node below one of these has already been reduced to one row per pair (or fewer)
+PG_REDUCING_NODES = ("Unique", "Limit", "Aggregate", "Subquery Scan")
+
+
+def configure_database(args):
+    """ The database is chosen when models is imported, so set it up before that """
+    os.environ.setdefault("APP_LOG_LEVEL", "WARNING")
+    if args.postgres:
+        if not os.environ.get("APP_DB_HOST"):
+            sys.exit("--postgres needs APP_DB_HOST, APP_DB_NAME, APP_DB_USER and APP_DB_PASSWD")
+        os.environ["PGOPTIONS"] = f"-c search_path={SCRATCH_SCHEMA}"
+    else:
+        os.environ.pop("APP_DB_HOST", None)
+        os.environ["APP_DB_PATH"] = os.path.join(tempfile.mkdtemp(), "query_plans.db")
+
+
+def load_history(stores, parts, records_per_pair):
+    """ Availability history shaped like production: many records per store / part pair """
+    from models import AvailabilityHistory
+
+    rng = random.Random(0)
+    start = datetime(2024, 9, 20)
+    rows = []
+    for store_number in stores:
+        for product_id, part_number in enumerate(parts, start=1):
+            time = start
+            for _ in range(records_per_pair):
+                time += timedelta(minutes=rng.randint(1, 180))
+                rows.append(dict(
+                    store_number=store_number,
+                    part_number=part_number,
+                    product_id=product_id,
+                    is_available=rng.random() < 0.1,
+                    inventory=0,
+                    create_time=time,
+                    update_time=time,
+                ))
+    AvailabilityHistory.chunked_insert_many(rows, chunk_size=1000)
+    return len(rows)
+
+
+def hot_queries(store_number, product):
+    """
+    name -> (query, full_scan_allowed)
+
+    "oldest" has to look at every store / part pair, so it may read a whole index
+    in order; the others must only touch the records they are about.
+    set_nearly_unavailable reads the (small) products and stores tables whole,
+    then runs the update_or_insert lookup for every pair.
+    """
+    from models import AvailabilityHistory, LatestAvailability, Product, Store
+
+    return {
+        "update_or_insert: last two records": (
+            AvailabilityHistory.query_latest_records(store_number, product.part_number, 2), False),
+        "is_product_available": (
+            LatestAvailability.query_product_availability(product).where(LatestAvailability.is_available == True), False),
+        "oldest": (
+            LatestAvailability.query_oldest(), True),
+        "set_availability_many: last two records of many pairs": (
+            AvailabilityHistory.query_latest_records_many(
+                [(store_number, product.part_number), (store_number, "PLAN000/A")], 2), False),
+        "set_nearly_unavailable: other products": (
+            Product.query_except([product.part_number]), True),
+        "set_nearly_unavailable: stores": (
+            Store.select(), True),
+    }
+
+
+def check_sqlite_plan(db, query, full_scan_allowed):
+    sql, params = query.sql()
+    rows = db.execute_sql(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    plan = [f"{'  ' * depth(rows, row)}{row[3]}" for row in rows]
+
+    # SQLite reports tables by their alias (peewee's t1, t2, ...)
+    history_names = {HISTORY_TABLE} | set(re.findall(rf'"{HISTORY_TABLE}" AS "(\w+)"', sql))
+
+    problems = []
+    history_scopes = set()
+    for node_id, parent, _, detail in rows:
+        if detail.startswith(("SCAN", "SEARCH")) and detail.split()[1] in history_names:
+            history_scopes.add(parent)
+            if detail.startswith("SCAN") and ("INDEX" not in detail or not full_scan_allowed):
+                problems.append(f"sequential scan: {detail}")
+    for node_id, parent, _, detail in rows:
+        if detail.startswith("USE TEMP B-TREE") and parent in history_scopes:
+            problems.append(f"sort over the history: {detail}")
+    return plan, problems
+
+
+def depth(rows, row):
+    parents = {r[0]: r[1] for r in rows}
+    level, parent = 0, row[1]
+    while parent:
+        level, parent = level + 1, parents.get(parent, 0)
+    return level
+
+
+def check_postgres_plan(db, query, full_scan_allowed):
+    sql, params = query.sql()
+    (result,) = db.execute_sql(f"EXPLAIN (FORMAT JSON) {sql}", params).fetchone()
+    if isinstance(result, str):
+        result = json.loads(result)
+    plan, problems = [], []
+
+    def walk(node, level):
+        node_type = node["Node Type"]
+        relation = node.get("Relation Name")
+        index = f" using {node['Index Name']}" if "Index Name" in node else ""
+        plan.append(f"{'  ' * level}{node_type}{f' on {relation}' if relation else ''}{index}")
+        if node_type == "Seq Scan" and relation == HISTORY_TABLE:
+            problems.append(f"sequential scan on {relation}")
+        if node_type.startswith("Index") and relation == HISTORY_TABLE \
+                and "Index Cond" not in node and not full_scan_allowed:
+            problems.append(f"full index scan on {relation} using {node.get('Index Name')}")
+        if node_type in ("Sort", "Incremental Sort") and reads_history(node):
+            problems.append(f"sort over the history: {node.get('Sort Key')}")
+        for child in node.get("Plans", ()):
+            walk(child, level + 1)
+
+    def reads_history(node):
+        """
+        True if the node's input is the whole of availability_history: neither
+        reduced first, nor restricted by an index condition to the records the
+        query is about (e.g. a bitmap scan of one part, which the planner may
+        prefer to reading the index in order, and then sort)
+        """
+        for child in node.get("Plans", ()):
+            if child["Node Type"] in PG_REDUCING_NODES:
+                continue
+            if child.get("Relation Name") == HISTORY_TABLE:
+                if "Index Cond" not in child and "Recheck Cond" not in child:
+                    return True
+            elif reads_history(child):
+                return True
+        return False
+
+    walk(result[0]["Plan"], 0)
+    return plan, problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that the hot queries use indexes.")
+    parser.add_argument("--postgres", action="store_true", help="Check on the PostgreSQL configured by APP_DB_*.")
+    parser.add_argument("--parts", type=int, default=60, help="Number of part numbers.")
+    parser.add_argument("--records-per-pair", type=int, default=300, help="History records per store / part pair.")
+    args = parser.parse_args()
+
+    configure_database(args)
+    if args.postgres:
+        import psycopg2
+
+        # create the scratch schema before models creates its tables in it
+        connect_params = dict(
+            dbname=os.environ["APP_DB_NAME"], host=os.environ["APP_DB_HOST"],
+            port=int(os.environ.get("APP_DB_PORT", 5432)),
+            user=os.environ["APP_DB_USER"], password=os.environ["APP_DB_PASSWD"],
+        )
+        with psycopg2.connect(**connect_params) as conn, conn.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE")
+            cursor.execute(f"CREATE SCHEMA {SCRATCH_SCHEMA}")
+
+    from models import db, Product, LatestAvailability
+    from fixtures import load_store_numbers
+
+    if args.postgres:
+        LatestAvailability.create_view()
+
+    stores = load_store_numbers()
+    parts = [f"PLAN{i:03}/A" for i in range(args.parts)]
+    for product_id, part_number in enumerate(parts, start=1):
+        # products.id has no default on PostgreSQL, give it the id the history refers to
+        Product.create(id=product_id, part_number=part_number)
+    row_count = load_history(stores, parts, args.records_per_pair)
+    db.execute_sql("ANALYZE")
+    print(f"Loaded {row_count} history records for {len(stores)} stores x {len(parts)} parts")
+
+    check_plan = check_postgres_plan if args.postgres else check_sqlite_plan
+    product = Product.get(Product.part_number == parts[len(parts) // 2])
+    failed = False
+    try:
+        for name, (query, full_scan_allowed) in hot_queries(stores[0], product).items():
+            plan, problems = check_plan(db, query, full_scan_allowed)
+            print(f"\n{'FAIL' if problems else 'ok'}  {name}")
+            for line in plan:
+                print(f"      {line}")
+            for problem in problems:
+                print(f"    ! {problem}")
+            failed = failed or bool(problems)
+    finally:
+        if args.postgres:
+            db.execute_sql(f"DROP SCHEMA {SCRATCH_SCHEMA} CASCADE")
+
+    sys.exit(1 if failed else 0)
@@ -1,7 +1,25 @@
+import atexit
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import threading
+import time
+from collections import Counter
 
-log_formatter = logging.Formatter(
+
+class TextFormatter(logging.Formatter):
+    """ The usual format, plus a note when similar records were suppressed by sampling """
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            text += f" ({suppressed} similar messages suppressed)"
+        return text
+
+
+log_formatter = TextFormatter(
     '[%(asctime)s][%(filename)s:%(lineno)d][%(levelname)s] %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S'
 )
@@ -10,19 +28,137 @@ is_debugging = os.environ.get('APP_DEBUG')
 log_level = os.environ.get('APP_LOG_LEVEL', 'INFO')
 if is_debugging:
     log_level = logging.DEBUG
+log_format = os.environ.get('APP_LOG_FORMAT', 'text')  # text or json
+
+# sampled messages: at most LOG_SAMPLE_BURST of each kind every LOG_SAMPLE_INTERVAL seconds
+LOG_SAMPLE_BURST = int(os.environ.get('APP_LOG_SAMPLE_BURST', 5))
+LOG_SAMPLE_INTERVAL = float(os.environ.get('APP_LOG_SAMPLE_INTERVAL', 60))
+
+# attributes every LogRecord has; anything else was passed with `extra=`
+_record_attributes = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per line, including the fields passed with `extra=` """
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            "level": record.levelname,
+            "logger": record.name,
+            "location": f"{record.filename}:{record.lineno}",
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _record_attributes:
+                data[key] = value
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Rate-limits records logged with `extra={"sample": "<kind>"}`: of each kind,
+    only the first `burst` records of every `interval` seconds pass. The first
+    record passing after a suppressed stretch tells how many were dropped.
+    Records without a kind always pass.
+    """
+    def __init__(self, burst=LOG_SAMPLE_BURST, interval=LOG_SAMPLE_INTERVAL):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._windows = {}  # kind -> [window start, passed, suppressed]
+
+    def filter(self, record):
+        kind = getattr(record, 'sample', None)
+        if kind is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.setdefault(kind, [now, 0, 0])
+            if now - window[0] >= self.interval:
+                window[0], window[1] = now, 0
+            if window[1] >= self.burst:
+                window[2] += 1
+                return False
+            window[1] += 1
+            if window[2]:
+                record.suppressed, window[2] = window[2], 0
+            return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread.
+
+    The stock QueueHandler formats each record before queueing it, so that it
+    can be pickled. Our queue stays in the process, so the record is queued as
+    is and the message is only built (if at all) off the caller's thread.
+    """
+    def prepare(self, record):
+        return record
+
+
+_log_queue = queue.SimpleQueue()
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(JsonFormatter() if log_format == 'json' else log_formatter)
+_queue_handler = DeferredQueueHandler(_log_queue)
+_queue_handler.addFilter(SamplingFilter())
+_listener = logging.handlers.QueueListener(_log_queue, _stream_handler, respect_handler_level=True)
+_listener.start()
+atexit.register(_listener.stop)
 
 
 def config_logger(logger_or_name, level=log_level):
+    """
+    Send a logger's records through the shared non-blocking queue.
+    Safe to call several times for the same logger.
+    """
     if isinstance(logger_or_name, str):
         logger = logging.getLogger(logger_or_name)
     else:
         logger = logger_or_name
     logger.setLevel(level)
 
-    handler = logging.StreamHandler()
-    handler.setFormatter(log_formatter)
-    logger.addHandler(handler)
+    if _queue_handler not in logger.handlers:
+        logger.addHandler(_queue_handler)
 
     return logger
 
+
+class PollStats:
+    """
+    Counters of what happened during one poll, logged as a single summary line
+    instead of one line per store x part.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._started = time.monotonic()
+
+    def start(self):
+        with self._lock:
+            self._counts = Counter()
+            self._started = time.monotonic()
+
+    def add(self, key, n=1):
+        with self._lock:
+            self._counts[key] += n
+
+    def log_summary(self, logger, label):
+        """ Log the counters since `start()` """
+        with self._lock:
+            counts = dict(self._counts)
+            elapsed = time.monotonic() - self._started
+        logger.info(
+            "Poll %s finished in %.1fs: %s", label, elapsed,
+            ", ".join(f"{key}={value}" for key, value in sorted(counts.items())) or "nothing stored",
+            extra={"poll": label, "elapsed": round(elapsed, 3), **counts},
+            stacklevel=2,
+        )
+
+
+poll_stats = PollStats()
+
 logger = config_logger(__name__)
@@ -0,0 +1,108 @@
+# auto-generated snapshot
+from peewee import *
+import datetime
+import peewee
+
+
+snapshot = Snapshot()
+
+
+@snapshot.append
+class AvailabilityHistory(peewee.Model):
+    store_number = CharField(max_length=10)
+    part_number = CharField(max_length=10)
+    product_id = IntegerField(null=True)
+    is_available = BooleanField()
+    inventory = IntegerField()
+    create_time = DateTimeField()
+    update_time = DateTimeField()
+    class Meta:
+        table_name = "availability_history"
+        indexes = (
+            (('store_number', 'product_id'), False),
+            (('store_number', 'part_number', 'update_time'), False),
+            (('part_number', 'store_number', 'update_time'), False),
+            )
+
+
+@snapshot.append
+class Product(peewee.Model):
+    id = IntegerField(primary_key=True)
+    part_number = CharField(max_length=10, unique=True)
+    product_title = CharField(max_length=255, null=True)
+    model = CharField(max_length=50, null=True)
+    finish = CharField(max_length=50, null=True)
+    capacity = CharField(max_length=10, null=True)
+    class Meta:
+        table_name = "products"
+        indexes = (
+            (('part_number',), True),
+            )
+
+
+@snapshot.append
+class Store(peewee.Model):
+    store_number = CharField(max_length=10, primary_key=True)
+    name = CharField(max_length=100)
+    country = CharField(max_length=2)
+    city = CharField(max_length=50)
+    address = CharField(max_length=255)
+    address2 = CharField(max_length=255, null=True)
+    address3 = CharField(max_length=255, null=True)
+    class Meta:
+        table_name = "stores"
+
+
+@snapshot.append
+class Subscriber(peewee.Model):
+    name = CharField(max_length=100)
+    push_key = CharField(max_length=255)
+    push_url = CharField(max_length=255, null=True)
+    is_active = BooleanField(default=True)
+    class Meta:
+        table_name = "subscribers"
+
+
+@snapshot.append
+class Subscription(peewee.Model):
+    subscriber = snapshot.ForeignKeyField(backref='subscriptions', index=True, model='subscriber', on_delete='CASCADE')
+    part_number = CharField(max_length=10, null=True)
+    model = CharField(max_length=50, null=True)
+    capacity = CharField(max_length=10, null=True)
+    finish = CharField(max_length=50, null=True)
+    store_number = CharField(max_length=10, null=True)
+    class Meta:
+        table_name = "subscriptions"
+
+
+LATEST_AVAILABILITY_VIEW = (
+    'CREATE OR REPLACE VIEW latest_availability AS ('
+    ' SELECT DISTINCT ON (store_number, part_number) *'
+    ' FROM availability_history'
+    ' ORDER BY store_number DESC, part_number DESC, update_time DESC'
+    ')'
+)
+
+PREVIOUS_LATEST_AVAILABILITY_VIEW = (
+    'CREATE OR REPLACE VIEW latest_availability AS ('
+    ' SELECT DISTINCT ON (store_number, part_number) *'
+    ' FROM availability_history'
+    ' ORDER BY store_number, part_number, update_time DESC'
+    ')'
+)
+
+
+def migrate_forward(op, old_orm, new_orm):
+    op.run_data_migration()
+    op.add_index(new_orm.availabilityhistory, 'availabilityhistory_part_number_store_number_update_time')
+    op.add_index(new_orm.availabilityhistory, 'availabilityhistory_store_number_part_number_update_time')
+    op.drop_index(old_orm.availabilityhistory, 'availabilityhistory_store_number_part_number')
+    op.sql(LATEST_AVAILABILITY_VIEW)
+
+
+def migrate_backward(op, old_orm, new_orm):
+    op.sql(PREVIOUS_LATEST_AVAILABILITY_VIEW)
+    op.run_data_migration()
+    op.add_index(new_orm.availabilityhistory, 'availabilityhistory_store_number_part_number')
+    op.drop_index(old_orm.availabilityhistory, 'availabilityhistory_part_number_store_number_update_time')
+    op.drop_index(old_orm.availabilityhistory, 'availabilityhistory_store_number_part_number_update_time')
@@ -0,0 +1,278 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from common import logger, poll_stats
+from transport import Transport, TransportError, TransportResponse, create_transport
+
+
+EGRESS_ROUTES = os.environ.get('APP_EGRESS_ROUTES', 'direct')
+EGRESS_BUDGET = int(os.environ.get('APP_EGRESS_BUDGET', 20))  # requests per window, per route
+EGRESS_WINDOW = float(os.environ.get('APP_EGRESS_WINDOW', 60))  # seconds
+EGRESS_MAX_FAILURES = int(os.environ.get('APP_EGRESS_MAX_FAILURES', 3))
+EGRESS_QUARANTINE = float(os.environ.get('APP_EGRESS_QUARANTINE', 300))  # seconds
+
+# Apple answers with these when an address is being throttled or blocked
+THROTTLED_STATUS_CODES = (403, 429, 503)
+
+
+class EgressRoute:
+    """
+    One way out to the Apple Store website: direct, through an HTTP proxy, or
+    bound to a local source address.
+
+    Each route owns its transport (and therefore its connections and cookie
+    jar), and keeps track of the requests it sent within the last `window`
+    seconds, so that no single address exceeds its budget.
+
+    Route spec examples:
+    - "direct"
+    - "http://127.0.0.1:3128" (HTTP proxy)
+    - "source:192.168.1.10" (source address)
+    """
+    def __init__(self, spec, budget=EGRESS_BUDGET, window=EGRESS_WINDOW, transport=None):
+        self.spec = spec
+        self.budget = budget
+        self.window = window
+        self.proxy = None
+        self.source_address = None
+        if spec.startswith("source:"):
+            self.source_address = spec.removeprefix("source:")
+        elif spec != "direct":
+            self.proxy = spec
+
+        self.transport: Transport = create_transport(
+            transport,
+            proxy=self.proxy,
+            source_address=self.source_address,
+        )
+        self.sent = deque()  # timestamps of requests within the window
+        self.in_flight = 0
+        self.failures = 0
+        self.quarantined_until = 0.0
+
+    def __repr__(self):
+        return f"<EgressRoute {self.spec}>"
+
+    def _expire(self, now):
+        while self.sent and self.sent[0] <= now - self.window:
+            self.sent.popleft()
+
+    def is_healthy(self, now):
+        return now >= self.quarantined_until
+
+    def load(self, now):
+        """ Fraction of the budget in use, including requests still in flight """
+        self._expire(now)
+        return (len(self.sent) + self.in_flight) / self.budget
+
+    def has_budget(self, now):
+        return self.load(now) < 1
+
+    def next_available_at(self, now):
+        """ Earliest time this route may be picked again """
+        if not self.is_healthy(now):
+            return self.quarantined_until
+        self._expire(now)
+        if len(self.sent) + self.in_flight < self.budget:
+            return now
+        if self.sent:
+            return self.sent[0] + self.window
+        # budget is taken by in-flight requests only; check again shortly
+        return now + 0.1
+
+    def quarantine(self, now, duration):
+        self.quarantined_until = now + duration
+        self.failures = 0
+        # drop cookies collected by this route, they may be what got us blocked
+        self.transport.clear_cookies()
+
+
+class EgressPool:
+    """
+    Schedules requests over a pool of egress routes.
+
+    A request goes to the least-loaded healthy route that still has budget.
+    When every route is exhausted, the caller waits until a slot frees up.
+    Routes that keep failing (network errors or throttling responses) are
+    quarantined for a while.
+    """
+    def __init__(self, routes, max_failures=EGRESS_MAX_FAILURES, quarantine=EGRESS_QUARANTINE):
+        if not routes:
+            raise ValueError("EgressPool requires at least one route")
+        self.routes = list(routes)
+        self.max_failures = max_failures
+        self.quarantine_duration = quarantine
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_specs(cls, specs, budget=EGRESS_BUDGET, window=EGRESS_WINDOW, transport=None, **kwargs):
+        if isinstance(specs, str):
+            specs = specs.split(",")
+        routes = [EgressRoute(spec.strip(), budget, window, transport) for spec in specs if spec.strip()]
+        return cls(routes, **kwargs)
+
+    @classmethod
+    def from_env(cls):
+        return cls.from_specs(EGRESS_ROUTES)
+
+    def acquire(self, exclude=(), wait=True) -> EgressRoute | None:
+        """
+        Reserve a slot on the least-loaded healthy route. If every healthy route
+        is out of budget, wait for a slot (or return None if `wait` is False).
+        Returns None if no route is healthy: quarantines are not waited out.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                healthy = [r for r in self.routes if r not in exclude and r.is_healthy(now)]
+                if not healthy:
+                    return None
+                candidates = [r for r in healthy if r.has_budget(now)]
+                if candidates:
+                    route = min(candidates, key=lambda r: r.load(now))
+                    route.sent.append(now)
+                    route.in_flight += 1
+                    poll_stats.add("requests")
+                    return route
+                if not wait:
+                    return None
+                wait_for = min(r.next_available_at(now) for r in healthy) - now
+
+            logger.debug("All egress routes are busy, waiting %.1fs", wait_for)
+            time.sleep(max(wait_for, 0.05))
+
+    def release(self, route: EgressRoute, ok: bool):
+        with self._lock:
+            route.in_flight -= 1
+            if ok:
+                route.failures = 0
+                return
+            route.failures += 1
+            if route.failures >= self.max_failures:
+                logger.warning("Quarantining egress route %s for %ss", route.spec, self.quarantine_duration)
+                route.quarantine(time.monotonic(), self.quarantine_duration)
+
+    def get(self, url, cookie_jar=None, update_cookie_jar=False, **kwargs) -> TransportResponse | None:
+        """
+        Send a GET request through the pool.
+
+        A request that fails on one route is retried once on another route, if
+        one is healthy and has budget right now. Returns None if all attempts
+        failed, or if every route is quarantined.
+        """
+        attempts = min(2, len(self.routes))
+        tried = []
+        for attempt in range(attempts):
+            route = self.acquire(exclude=tried, wait=attempt == 0)
+            if route is None:
+                logger.warning("No egress route available for %s", url)
+                break
+            tried.append(route)
+
+            if cookie_jar:
+                with open(cookie_jar, 'r') as f:
+                    route.transport.update_cookies(json.load(f))
+
+            try:
+                response = route.transport.get(url, **kwargs)
+            except TransportError as e:
+                logger.error("Request via %s failed: %s", route.spec, e)
+                self.release(route, ok=False)
+                continue
+
+            if not self._check_response(route, response):
+                continue
+
+            if update_cookie_jar and cookie_jar:
+                with open(cookie_jar, 'w') as f:
+                    json.dump(route.transport.get_cookies(), f)
+
+            return response
+
+        return None
+
+    def get_many(self, urls, **kwargs) -> list[TransportResponse | None]:
+        """
+        Send several GET requests concurrently.
+
+        Requests are sent in rounds that fit the budget free right now, and
+        requests assigned to the same route are handed to its transport
+        together, so that a multiplexing transport sends them over one
+        connection. Like `get`, the failed or throttled requests of a round are
+        retried once on another route, if one is healthy and has budget right
+        now. Results are in the order of `urls`, with None for failed requests
+        (or for all remaining ones once every route is quarantined).
+        """
+        responses = [None] * len(urls)
+        pending = list(range(len(urls)))
+        while pending:
+            # wait for one slot, then take whatever else is free without waiting
+            route = self.acquire()
+            if route is None:
+                logger.warning("No egress route available for %d requests", len(pending))
+                break
+            assignments = [route]
+            while len(assignments) < len(pending):
+                route = self.acquire(wait=False)
+                if route is None:
+                    break
+                assignments.append(route)
+            round_indices, pending = pending[:len(assignments)], pending[len(assignments):]
+
+            by_route: dict[EgressRoute, list[int]] = {}
+            for i, route in zip(round_indices, assignments):
+                by_route.setdefault(route, []).append(i)
+            failed = self._fetch_round(urls, by_route, responses, **kwargs)
+            if failed and len(self.routes) > 1:
+                self._retry_round(urls, failed, responses, **kwargs)
+        return responses
+
+    def _retry_round(self, urls, failed: dict[int, EgressRoute], responses, **kwargs):
+        """ Retry each failed request once on a route other than the one it failed on """
+        by_route: dict[EgressRoute, list[int]] = {}
+        for i, failed_route in failed.items():
+            route = self.acquire(exclude=[failed_route], wait=False)
+            if route is None:
+                logger.warning("No other egress route available to retry %s", urls[i])
+                continue
+            by_route.setdefault(route, []).append(i)
+        if by_route:
+            self._fetch_round(urls, by_route, responses, **kwargs)
+
+    def _fetch_round(self, urls, by_route, responses, **kwargs) -> dict[int, EgressRoute]:
+        """
+        Send the requests reserved on each route, releasing the slots as they
+        finish. Returns the indices of the failed requests, with their route.
+        """
+        def fetch_route(route, indices):
+            results = route.transport.get_many([urls[i] for i in indices], **kwargs)
+            return route, indices, results
+
+        failed = {}
+        with ThreadPoolExecutor(max_workers=len(by_route)) as executor:
+            for route, indices, results in executor.map(lambda item: fetch_route(*item), by_route.items()):
+                for i, result in zip(indices, results):
+                    if isinstance(result, TransportError):
+                        logger.error("Request via %s failed: %s", route.spec, result)
+                        self.release(route, ok=False)
+                        failed[i] = route
+                    elif self._check_response(route, result):
+                        responses[i] = result
+                    else:
+                        failed[i] = route
+        return failed
+
+    def _check_response(self, route, response) -> bool:
+        """ Release the route slot taken by `response`; False if the route was throttled """
+        throttled = response.status_code in THROTTLED_STATUS_CODES
+        self.release(route, ok=not throttled)
+        if throttled:
+            logger.warning("Request via %s throttled with status %d", route.spec, response.status_code)
+        return not throttled
+
+
+egress_pool = EgressPool.from_env()
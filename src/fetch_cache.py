@@ -0,0 +1,165 @@
+import copy
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from urllib.parse import urlparse
+
+from common import poll_stats
+from egress import egress_pool, EgressPool
+from transport import TransportResponse
+
+
+FETCH_CACHE_TTL = float(os.environ.get('APP_FETCH_CACHE_TTL', 10))  # seconds, 0 disables caching
+# per endpoint overrides, e.g. "pickup-message-recommendations=30,fulfillment-messages=5"
+FETCH_CACHE_TTLS = os.environ.get('APP_FETCH_CACHE_TTLS', '')
+FETCH_CACHE_SIZE = int(os.environ.get('APP_FETCH_CACHE_SIZE', 256))  # responses kept per endpoint
+
+
+def endpoint_of(url) -> str:
+    """ "https://www.apple.com/hk-zh/shop/fulfillment-messages?..." -> "fulfillment-messages" """
+    return urlparse(url).path.rstrip("/").rsplit("/", 1)[-1]
+
+
+def parse_ttls(text) -> dict[str, float]:
+    ttls = {}
+    for item in text.split(","):
+        if item.strip():
+            endpoint, ttl = item.split("=")
+            ttls[endpoint.strip()] = float(ttl)
+    return ttls
+
+
+class FetchCache:
+    """
+    Sits in front of the egress pool, so that the same URL isn't requested
+    from Apple twice within a few seconds.
+
+    - Single flight: concurrent callers for a URL that is already being
+      fetched wait for that request instead of sending their own.
+    - Short TTL cache: successful responses are reused for `ttl` seconds
+      (per endpoint), keeping at most `max_entries` per endpoint, least
+      recently used first out.
+
+    Responses served from the cache or from another caller's request are
+    copies marked `from_cache`: whoever sent the request already stored them.
+
+    Hits, misses and coalesced requests are counted per endpoint, and added
+    to the poll summary.
+    """
+    def __init__(self, pool: EgressPool, ttl=FETCH_CACHE_TTL, ttls=None, max_entries=FETCH_CACHE_SIZE):
+        self.pool = pool
+        self.ttl = ttl
+        self.ttls = parse_ttls(FETCH_CACHE_TTLS) if ttls is None else ttls
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: dict[str, OrderedDict[str, tuple[float, TransportResponse]]] = {}
+        self._in_flight: dict[str, Future] = {}
+        self.counts = Counter()  # (endpoint, "hit" | "miss" | "coalesced") -> count
+
+    def _count(self, endpoint, kind):
+        self.counts[(endpoint, kind)] += 1
+        poll_stats.add(f"cache_{kind}")
+
+    def _lookup(self, url, now) -> TransportResponse | None:
+        """ Cached response for url, if still fresh. Call with the lock held """
+        entries = self._entries.get(endpoint_of(url))
+        if not entries or url not in entries:
+            return None
+        expires_at, response = entries[url]
+        if expires_at <= now:
+            del entries[url]
+            return None
+        entries.move_to_end(url)
+        return response
+
+    def _store(self, url, response, now):
+        """ Call with the lock held """
+        endpoint = endpoint_of(url)
+        ttl = self.ttls.get(endpoint, self.ttl)
+        if ttl <= 0 or response is None or response.status_code != 200:
+            return
+        entries = self._entries.setdefault(endpoint, OrderedDict())
+        entries[url] = (now + ttl, response)
+        entries.move_to_end(url)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def _claim(self, urls) -> tuple[dict, dict, list[str]]:
+        """
+        Sort urls into cached responses, requests already in flight to wait
+        for, and urls this caller has to fetch (registered as in flight).
+        """
+        cached, waiting, to_fetch = {}, {}, []
+        with self._lock:
+            now = time.monotonic()
+            for url in dict.fromkeys(urls):
+                endpoint = endpoint_of(url)
+                response = self._lookup(url, now)
+                if response is not None:
+                    cached[url] = response
+                    self._count(endpoint, "hit")
+                elif url in self._in_flight:
+                    waiting[url] = self._in_flight[url]
+                    self._count(endpoint, "coalesced")
+                else:
+                    self._in_flight[url] = Future()
+                    to_fetch.append(url)
+                    self._count(endpoint, "miss")
+        return cached, waiting, to_fetch
+
+    def _complete(self, results: dict):
+        """ Publish fetched responses to the cache and to the callers waiting for them """
+        with self._lock:
+            now = time.monotonic()
+            futures = []
+            for url, response in results.items():
+                self._store(url, response, now)
+                futures.append((self._in_flight.pop(url), response))
+        for future, response in futures:
+            future.set_result(response)
+
+    def get(self, url, cookie_jar=None, update_cookie_jar=False, **kwargs) -> TransportResponse | None:
+        if update_cookie_jar:
+            # the caller wants the cookies of a fresh response
+            return self.pool.get(url, cookie_jar=cookie_jar, update_cookie_jar=True, **kwargs)
+        if cookie_jar:
+            kwargs["cookie_jar"] = cookie_jar
+        return self.get_many([url], **kwargs)[0]
+
+    def get_many(self, urls, **kwargs) -> list[TransportResponse | None]:
+        """ Like EgressPool.get_many, answering from the cache or in-flight requests where possible """
+        cached, waiting, to_fetch = self._claim(urls)
+        results = dict.fromkeys(to_fetch)
+        try:
+            if len(to_fetch) == 1:
+                # a single request goes through get, which also handles the cookie jar
+                results[to_fetch[0]] = self.pool.get(to_fetch[0], **kwargs)
+            elif to_fetch:
+                results.update(zip(to_fetch, self.pool.get_many(to_fetch, **kwargs)))
+        finally:
+            # also on errors, so that nobody waits forever
+            self._complete(results)
+
+        responses = dict(results)
+        for url, response in cached.items():
+            responses[url] = self._shared(response)
+        for url, future in waiting.items():
+            responses[url] = self._shared(future.result())
+        return [responses[url] for url in urls]
+
+    @staticmethod
+    def _shared(response):
+        if response is None:
+            return None
+        response = copy.copy(response)
+        response.from_cache = True
+        return response
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+fetch_cache = FetchCache(egress_pool)
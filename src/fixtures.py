@@ -0,0 +1,14 @@
+from pathlib import Path
+
+FIXTURE_PATH = Path(__file__).parent.parent / "fixture.yml"
+
+
+def load_store_numbers():
+    """ Store numbers of fixture.yml, for the benchmarks and checks """
+    # avoid a yaml dependency: store numbers are all we need from the fixture
+    store_numbers = []
+    for line in FIXTURE_PATH.read_text(encoding="utf-8").splitlines():
+        line = line.strip()
+        if line.startswith("store_number:"):
+            store_numbers.append(line.split(":", 1)[1].strip())
+    return store_numbers
@@ -1,13 +1,23 @@
-from .base import db, Model, MyJsonEncoder
+from peewee import SqliteDatabase
+
+from .base import db, Model, MyJsonEncoder, SQLITE_PROFILE
 from .models import (
     Product, Store, AvailabilityHistory,
     LatestAvailability,  # view
+    Subscriber, Subscription,
+    Transition,
 )
 
 all_models = (
     Store,
     Product,
     AvailabilityHistory,
+    Subscriber,
+    Subscription,
 )
 
 db.create_tables(all_models)
+
+if isinstance(db, SqliteDatabase):
+    # on PostgreSQL the view is managed by migrations
+    LatestAvailability.create_view()
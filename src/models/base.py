@@ -15,12 +15,25 @@ import logging
 from common import config_logger
 
 if os.environ.get('APP_DEBUG_ECHO_SQL'):
-    logger = logging.getLogger('peewee')
-    logger.addHandler(logging.StreamHandler())
-    logger.setLevel(logging.DEBUG)
+    config_logger('peewee', logging.DEBUG)
 
 DB_Path = os.environ.get('APP_DB_PATH', ':memory:')
 DB_HOST = os.environ.get('APP_DB_HOST')
+SQLITE_PROFILE = os.environ.get('APP_DB_SQLITE_PROFILE', 'default')
+
+SQLITE_PROFILES = {
+    'default': {},
+    # For single-box deployments with parallel fetch workers. WAL lets reads run
+    # while a write is in progress; writes are expected to go through a single
+    # writer thread (see write_behind.py), which is enabled with this profile.
+    'throughput': {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',  # with WAL, only checkpoints wait for fsync
+        'cache_size': -64 * 1024,  # 64 MB
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'memory',
+    },
+}
 
 logger = logging.getLogger(__name__)
 config_logger(logger)
@@ -35,13 +48,17 @@ if DB_HOST:
         password=os.environ['APP_DB_PASSWD'],  # Ditto.
         autorollback=True,
     )
-    logger.info(f"Connected to Postgres at {db.connect_params["host"]}:{db.connect_params["port"]}")
+    logger.info("Connected to Postgres at %s:%s", db.connect_params["host"], db.connect_params["port"])
 
 # fall back to SQLite
 else:
     # Database: SQLite
-    db = SqliteDatabase(DB_Path)
-    logger.info(f"Connected to SQLite at {DB_Path}")
+    db = SqliteDatabase(
+        DB_Path,
+        pragmas=SQLITE_PROFILES[SQLITE_PROFILE],
+        timeout=10,  # seconds to wait for a lock before "database is locked"
+    )
+    logger.info("Connected to SQLite at %s (%s profile)", DB_Path, SQLITE_PROFILE)
 
 
 class Model(_Model):
@@ -78,10 +95,11 @@ class Model(_Model):
         cnt = 0
         with cls._meta.database.atomic():
             for batch in chunked(rows, chunk_size):
-                # NOTE: use returning() to disable returned data of PostgreSQL.
+                # NOTE: use as_rowcount() to get the inserted row count rather than the
+                #       returned ids (or a cursor) on PostgreSQL.
                 #       see http://docs.peewee-orm.com/en/latest/peewee/api.html#Model.insert_many
                 cnt += cls.insert_many(batch, fields) \
-                          .returning() \
+                          .as_rowcount() \
                           .execute()
         return cnt
 
@@ -1,17 +1,26 @@
 from datetime import datetime
+from functools import reduce
+import operator
 import re
+from typing import NamedTuple
 
 from peewee import (
-    AutoField, IntegerField, CharField, DateTimeField, BooleanField
+    AutoField, IntegerField, CharField, DateTimeField, BooleanField,
+    ForeignKeyField, PostgresqlDatabase,
 )
 
 from .base import db, Model
-from common import logger
+from common import logger, poll_stats
 from api_helpers import (
     parse_inventory_from_product_details,
+    parse_product_title,
     try_parse_product_details,
 )
 
+# SQLite allows at most 500 terms in a compound SELECT
+LATEST_RECORDS_PAIRS_PER_QUERY = 100
+
+
 class Store(Model):
     store_number = CharField(primary_key=True, max_length=10)
     name = CharField(max_length=100)
@@ -49,6 +58,37 @@ class Product(Model):
         except cls.DoesNotExist:
             return None
 
+    @classmethod
+    def query_except(cls, part_numbers):
+        return cls.select().where(cls.part_number.not_in(part_numbers))
+
+    @property
+    def attributes(self) -> dict[str, str | None]:
+        """ model, capacity and finish, parsed from product_title where the columns are empty """
+        attributes = dict(model=self.model, capacity=self.capacity, finish=self.finish)
+        if self.product_title and None in attributes.values():
+            parsed = parse_product_title(self.product_title)
+            attributes = {name: value or parsed[i] for i, (name, value) in enumerate(attributes.items())}
+        return attributes
+
+    @classmethod
+    def select_matching(cls, model=None, capacity=None, finish=None) -> list["Product"]:
+        """ Products matching the given attributes (case insensitive), in id order """
+        wanted = {name: value.casefold() for name, value in
+                  dict(model=model, capacity=capacity, finish=finish).items() if value}
+        return [
+            product for product in cls.select().order_by(cls.id)
+            if all((product.attributes[name] or "").casefold() == value for name, value in wanted.items())
+        ]
+
+
+class Transition(NamedTuple):
+    """ A change of availability of a product at a store """
+    store_number: str
+    part_number: str
+    is_available: bool
+    inventory: int
+
 
 class AvailabilityHistory(Model):
     """
@@ -76,32 +116,38 @@ class AvailabilityHistory(Model):
         db_table = 'availability_history'
         indexes = (
             (('store_number', 'product_id'), False),
-            (('store_number', 'part_number'), False),
+            # update_time is part of the keys so that the "latest records" lookups
+            # and the latest_availability view read the index in order, instead of sorting
+            (('store_number', 'part_number', 'update_time'), False),  # lookups by pair
+            (('part_number', 'store_number', 'update_time'), False),  # lookups by product
         )
 
     @classmethod
-    def set_nearly_unavailable(cls, available_products):
-        query_other_products = \
-                Product.select() \
-                .where(Product.part_number.not_in(available_products))
+    def set_nearly_unavailable(cls, available_products, observed_time=None) -> list[Transition]:
+        query_other_products = Product.query_except(available_products)
 
-        logger.warning(f"Except {available_products}, update all others to unavailable")
+        logger.warning("Except %s, update all others to unavailable", available_products)
         product: Product
         store: Store
+        transitions = []
         for product in query_other_products:
             for store in Store.select():
-                cls.update_or_insert(
+                transition = cls.update_or_insert(
                     store.store_number,
                     product,
                     is_available=False,
-                    inventory=0
+                    inventory=0,
+                    observed_time=observed_time,
                 )
+                if transition:
+                    transitions.append(transition)
+        return transitions
 
     @classmethod
-    def set_availability(cls, store_number, part_number, is_available, product_details=None):
+    def set_availability(cls, store_number, part_number, is_available, product_details=None, observed_time=None) -> Transition | None:
         product_properties = try_parse_product_details(product_details)
-        logger.info(f"Storing availability: store_number={store_number}, part_number={part_number}, is_available={is_available}")
-        logger.debug(product_properties.get("product_title", "no product_title"))
+        logger.debug("Storing availability: store_number=%s, part_number=%s, is_available=%s",
+                     store_number, part_number, is_available, extra={"sample": "store_availability"})
         product : Product
         product, _ = Product.get_or_create(
                         part_number=part_number,
@@ -113,36 +159,97 @@ class AvailabilityHistory(Model):
 
         inventory = parse_inventory_from_product_details(product_details) or 0
 
-        cls.update_or_insert(store_number, product, is_available, inventory)
+        return cls.update_or_insert(store_number, product, is_available, inventory, observed_time)
 
     @classmethod
-    def update_or_insert(cls, store_number, product: Product, is_available: bool, inventory: int):
-        store: Store = Store.get_by_id(store_number)
+    def set_availability_many(cls, observations, observed_time=None) -> list[Transition]:
+        """
+        set_availability for many (store_number, part_number, is_available, product_details)
+        observations at once, in a handful of queries: one for the products, one per
+        LATEST_RECORDS_PAIRS_PER_QUERY pairs for their last two records, one insert and
+        one update.
+        """
+        observations = list(observations)
+        # any store's details describe the product: keep the first that can be parsed
+        properties_by_part = {}
+        for _, part_number, _, details in observations:
+            if not properties_by_part.get(part_number):
+                properties_by_part[part_number] = try_parse_product_details(details)
+        # a later observation of the same pair replaces an earlier one
+        observations = {(o[0], o[1]): o for o in observations}
+        if not observations:
+            return []
+        current_time = observed_time or datetime.now()
+
+        products = {p.part_number: p for p in Product.select().where(Product.part_number.in_(list(properties_by_part)))}
+        for part_number, product_properties in properties_by_part.items():
+            product = products.get(part_number)
+            if product is None:
+                products[part_number] = Product.create(part_number=part_number, **product_properties)
+            elif product_properties and (product.product_title is None or product.model is None):
+                product.update_from_dict(product_properties)
+                product.save()
+
+        last_records = {}  # (store_number, part_number) -> [current, previous]
+        pairs = list(observations)
+        for i in range(0, len(pairs), LATEST_RECORDS_PAIRS_PER_QUERY):
+            for record in cls.query_latest_records_many(pairs[i:i + LATEST_RECORDS_PAIRS_PER_QUERY], 2):
+                last_records.setdefault((record.store_number, record.part_number), []).append(record)
+        for records in last_records.values():
+            records.sort(key=lambda record: record.update_time, reverse=True)
+
+        inserts, updates, transitions = [], [], []
+        for (store_number, part_number), (_, _, is_available, details) in observations.items():
+            inventory = parse_inventory_from_product_details(details) or 0
+            records = last_records.get((store_number, part_number), [])
+            current_record = records[0] if len(records) > 0 else None
+            previous_record = records[1] if len(records) > 1 else None
+
+            if cls.extends_latest_record(current_record, previous_record, is_available, inventory):
+                updates.append(current_record.id)
+            else:
+                inserts.append(dict(
+                    store_number=store_number,
+                    part_number=part_number,
+                    product_id=products[part_number].id,
+                    is_available=is_available,
+                    inventory=inventory,
+                    update_time=current_time,
+                    create_time=current_time,
+                ))
+
+            if cls.is_transition(current_record, is_available):
+                transitions.append(Transition(store_number, part_number, is_available, inventory))
+
+        with db.atomic():
+            if inserts:
+                cls.insert_many(inserts).execute()
+            if updates:
+                cls.update(update_time=current_time).where(cls.id.in_(updates)).execute()
+        poll_stats.add("inserted", len(inserts))
+        poll_stats.add("updated", len(updates))
+        poll_stats.add("transitions", len(transitions))
+        logger.debug("AvailabilityHistory: %d inserted, %d updated for %d pairs",
+                     len(inserts), len(updates), len(pairs))
+        return transitions
 
+    @classmethod
+    def update_or_insert(cls, store_number, product: Product, is_available: bool, inventory: int,
+                         observed_time: datetime = None) -> Transition | None:
+        """
+        Store the availability following the rules above.
+        `observed_time` defaults to now; it is set when writing observations made earlier.
+        Returns a Transition if the availability of the pair changed, otherwise None.
+        """
         # Retrieve the last two records for the given store and product
-        select_latest_two_records = (
-            AvailabilityHistory
-            .select()
-            .where((AvailabilityHistory.store_number == store_number) & 
-                   (AvailabilityHistory.part_number == product.part_number))
-            .order_by(AvailabilityHistory.update_time.desc())
-            .limit(2)
-        )
-
-        last_records = list(select_latest_two_records)
+        last_records = list(cls.query_latest_records(store_number, product.part_number, 2))
 
         current_record: cls = last_records[0] if len(last_records) > 0 else None
         previous_record: cls = last_records[1] if len(last_records) > 1 else None
 
-        should_insert = True
-        if current_record and previous_record \
-                and is_available == current_record.is_available \
-                and is_available == previous_record.is_available \
-                and inventory == current_record.inventory \
-                and inventory == previous_record.inventory:
-            should_insert = False
+        should_insert = not cls.extends_latest_record(current_record, previous_record, is_available, inventory)
 
-        current_time = datetime.now()
+        current_time = observed_time or datetime.now()
         if should_insert:
             AvailabilityHistory.create(
                 store_number=store_number,
@@ -153,11 +260,66 @@ class AvailabilityHistory(Model):
                 update_time=current_time,
                 create_time=current_time,
             )
-            logger.info(f"AvailabilityHistory: inserted availability {is_available} for {product.part_number} ({product.product_title}) at store {store_number} ({store.name})")
+            poll_stats.add("inserted")
+            logger.debug("AvailabilityHistory: inserted availability %s for %s (%s) at store %s",
+                         is_available, product.part_number, product.product_title, store_number,
+                         extra={"sample": "history_write"})
         else:
             current_record.update_time = current_time
             current_record.save()
-            logger.info(f"AvailabilityHistory: updated availability {is_available} for {product.part_number} ({product.product_title}) at store {store_number} ({store.name})")
+            poll_stats.add("updated")
+            logger.debug("AvailabilityHistory: updated availability %s for %s (%s) at store %s",
+                         is_available, product.part_number, product.product_title, store_number,
+                         extra={"sample": "history_write"})
+
+        if cls.is_transition(current_record, is_available):
+            poll_stats.add("transitions")
+            return Transition(store_number, product.part_number, is_available, inventory)
+        return None
+
+    @staticmethod
+    def extends_latest_record(current_record, previous_record, is_available, inventory) -> bool:
+        """
+        Rule 3 above: if the last two records already have this state, the latest
+        one's update_time is moved forward instead of inserting another record.
+        """
+        return bool(current_record and previous_record
+                    and is_available == current_record.is_available
+                    and is_available == previous_record.is_available
+                    and inventory == current_record.inventory
+                    and inventory == previous_record.inventory)
+
+    @staticmethod
+    def is_transition(current_record, is_available) -> bool:
+        # a pair seen for the first time only counts as a change if it is available
+        return is_available != current_record.is_available if current_record else bool(is_available)
+
+    @classmethod
+    def query_latest_records(cls, store_number, part_number, limit):
+        return (
+            AvailabilityHistory
+            .select()
+            .where((AvailabilityHistory.store_number == store_number) &
+                   (AvailabilityHistory.part_number == part_number))
+            .order_by(AvailabilityHistory.update_time.desc())
+            .limit(limit)
+        )
+
+    @classmethod
+    def query_latest_records_many(cls, pairs, limit):
+        """
+        The last `limit` records of each (store_number, part_number) pair, in one
+        query: the query_latest_records lookups combined with UNION ALL, so each
+        one is still read from the index in order.
+        """
+        subqueries = []
+        for store_number, part_number in pairs:
+            query = cls.query_latest_records(store_number, part_number, limit)
+            subqueries.append(query.select_from(
+                query.c.id, query.c.store_number, query.c.part_number,
+                query.c.is_available, query.c.inventory, query.c.update_time,
+            ))
+        return reduce(operator.add, subqueries).objects(AvailabilityHistory)
 
     @classmethod
     def query_latest_availability(cls):
@@ -170,21 +332,101 @@ class AvailabilityHistory(Model):
         return latest_availability
 
 
+class Subscriber(Model):
+    """ Someone who receives notifications, with their own PushDeer target """
+    id = AutoField(primary_key=True)
+    name = CharField(max_length=100)
+    push_key = CharField(max_length=255)
+    push_url = CharField(max_length=255, null=True)  # defaults to PUSHDEER_URL
+    is_active = BooleanField(default=True)
+
+    class Meta:
+        database = db
+        db_table = 'subscribers'
+
+
+class Subscription(Model):
+    """
+    What a subscriber is waiting for.
+
+    Every non-null field narrows the subscription down, null means "any".
+    E.g. model="iPhone 16 Pro", capacity="256GB" matches every finish in every store.
+    A subscriber is notified if any of their subscriptions matches.
+    """
+    id = AutoField(primary_key=True)
+    subscriber = ForeignKeyField(Subscriber, backref='subscriptions', on_delete='CASCADE')
+    part_number = CharField(max_length=10, null=True)
+    model = CharField(max_length=50, null=True)
+    capacity = CharField(max_length=10, null=True)
+    finish = CharField(max_length=50, null=True)
+    store_number = CharField(max_length=10, null=True)
+
+    class Meta:
+        database = db
+        db_table = 'subscriptions'
+
+    def matches_product(self, product: Product) -> bool:
+        if self.part_number is not None:
+            return self.part_number == product.part_number
+        return all(
+            expected is None or expected == actual
+            for expected, actual in (
+                (self.model, product.model),
+                (self.capacity, product.capacity),
+                (self.finish, product.finish),
+            )
+        )
+
+
 class LatestAvailability(AvailabilityHistory):
     """
-    A view of AvailabilityHistory with the latest availability of each product - store pair:
+    A view of AvailabilityHistory with the latest availability of each product - store pair.
+
+    PostgreSQL (created by migration 0004):
 
     CREATE VIEW latest_availability AS (
     SELECT DISTINCT ON (store_number, part_number)
         *
     FROM availability_history
-    ORDER BY store_number, part_number, update_time DESC
+    ORDER BY store_number DESC, part_number DESC, update_time DESC
     );
+
+    The ORDER BY is descending on every column so that it is a backward scan of the
+    (store_number, part_number, update_time) index, without a sort.
+
+    SQLite has no DISTINCT ON: there the view relies on bare columns of an aggregate
+    query taking their values from the row holding the MAX().
     """
+    view_sql = {
+        'postgresql': (
+            'CREATE OR REPLACE VIEW latest_availability AS ('
+            ' SELECT DISTINCT ON (store_number, part_number) *'
+            ' FROM availability_history'
+            ' ORDER BY store_number DESC, part_number DESC, update_time DESC'
+            ')'
+        ),
+        'sqlite': (
+            'CREATE VIEW IF NOT EXISTS latest_availability AS'
+            ' SELECT id, store_number, part_number, product_id, is_available, inventory, create_time,'
+            ' MAX(update_time) AS update_time'
+            ' FROM availability_history'
+            ' GROUP BY store_number, part_number'
+        ),
+    }
+
     class Meta:
         database = db
         db_table = 'latest_availability'
 
+    @classmethod
+    def create_view(cls):
+        dialect = 'postgresql' if isinstance(db, PostgresqlDatabase) else 'sqlite'
+        db.execute_sql(cls.view_sql[dialect])
+
+    @classmethod
+    def query_oldest(cls):
+        return LatestAvailability.select().order_by(LatestAvailability.update_time).limit(1)
+
     @classmethod
     def query_available(cls, is_available):
         return LatestAvailability.select().where(LatestAvailability.is_available == is_available)
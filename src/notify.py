@@ -1,11 +1,34 @@
 import requests
 import os
 
+from peewee import chunked
+
 from common import logger
 
 push_url = os.environ.get("PUSHDEER_URL")
 push_key = os.environ.get("PUSHDEER_KEY")
 
+# PushDeer accepts several comma separated keys in one request, up to its
+# MAX_PUSH_KEY_PER_TIME (10 by default, and on the hosted service)
+push_keys_per_request = int(os.environ.get("PUSHDEER_KEYS_PER_REQUEST", 10))
+
+
+class PushError(Exception):
+    pass
+
+
+def push(url, params) -> dict:
+    """
+    Send one PushDeer request. PushDeer reports errors (e.g. too many keys)
+    with a nonzero "code" in a 200 response, so that is checked too.
+    """
+    response = requests.get(url, params=params)
+    response.raise_for_status()
+    result = response.json()
+    if result.get("code", 0) != 0:
+        raise PushError(f"PushDeer error {result.get('code')}: {result.get('error') or result}")
+    return result
+
 
 if not push_url or not push_key:
     logger.error("PushDeer URL or key not set in environment variables")
@@ -20,11 +43,28 @@ def send_text(text):
         "text": text
     }
     try:
-        response = requests.get(push_url, params=params)
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        logger.error(f"Error sending notification: {e}")
+        return push(push_url, params)
+    except (requests.RequestException, ValueError, PushError) as e:
+        logger.error("Error sending notification: %s", e)
+
+
+def send_text_to_many(text, push_keys, url=None):
+    """
+    Send the same text to many push keys, batching the keys into as few
+    requests as possible.
+    """
+    url = url or push_url
+    results = []
+    for batch in chunked(push_keys, push_keys_per_request):
+        params = {
+            "pushkey": ",".join(batch),
+            "text": text
+        }
+        try:
+            results.append(push(url, params))
+        except (requests.RequestException, ValueError, PushError) as e:
+            logger.error("Error sending notification to %d subscribers: %s", len(batch), e)
+    return results
 
 
 if __name__ == "__main__":
@@ -2,15 +2,18 @@ from datetime import datetime
 import time
 
 import schedule
+from peewee import PeeweeException
 
 from check_availability import (
-    check_product_availability,
     check_availability,
     models
 )
+from availability_matrix import availability_matrix
+from common import logger
+from subscriptions import subscription_index
 
 
-def real_job(product=None, randomly=False, oldest=False):
+def real_job(product=None, randomly=False, oldest=False, sweep=False):
     current_time = datetime.now()
     print(current_time.isoformat())
     try:
@@ -18,37 +21,73 @@ def real_job(product=None, randomly=False, oldest=False):
             check_availability(pick_mode="random")
         elif oldest:
             check_availability(pick_mode="oldest", recursive=True)
+        elif sweep:
+            check_availability(pick_mode="sweep")
         else:
-            check_product_availability(product)
+            check_availability(product)
     except RuntimeError as e:
         print(e)
+    except PeeweeException as e:
+        # e.g. the database is unavailable: skip this poll, keep the scheduler running
+        logger.error("Poll failed on a database error: %s", e)
+
+
+def reload_subscriptions():
+    try:
+        subscription_index.load()
+    except PeeweeException as e:
+        logger.error("Could not reload subscriptions: %s", e)
 
 
 start_time = datetime.now()
 
 
-if __name__ == "__main__":
-    s1: schedule.Scheduler = schedule.Scheduler()
-    s1.allow_at = lambda t: '06:00' <= t.time().strftime("%H:%M") < "22:00"
-    s1.every(1).to(3).minutes.do(real_job, product=models["desert-256g"])
-    # test
-    # s1.every(3).to(5).seconds.do(real_job, oldest=True)
+# (allowed time window, jobs as (every, to, unit, real_job kwargs)); None means always allowed.
+# simulate_polling.py replays recorded history against this schedule.
+schedules = [
+    (("06:00", "22:00"), [
+        (1, 3, "minutes", dict(product=models["desert-256g"])),
+        # the whole catalog, every few hours
+        (3, 4, "hours", dict(sweep=True)),
+        # test
+        # (3, 5, "seconds", dict(oldest=True)),
+    ]),
+    (("07:00", "09:30"), [
+        (15, 60, "seconds", dict(randomly=True)),
+        (10, 30, "seconds", dict(product=models["desert-256g"])),
+    ]),
+    (None, [
+        (2, 5, "minutes", dict(oldest=True)),
+    ]),
+]
 
-    s2 = schedule.Scheduler()
-    s2.allow_at = lambda t: '07:00' <= t.time().strftime("%H:%M") < "09:30"
-    s2.every(15).to(60).seconds.do(real_job, randomly=True)
-    s2.every(10).to(30).seconds.do(real_job, product=models["desert-256g"])
 
-    s3: schedule.Scheduler = schedule.Scheduler()
-    s3.allow_at = lambda t: True
-    s3.every(2).to(5).minutes.do(real_job, oldest=True)
+def allow_between(window):
+    if window is None:
+        return lambda t: True
+    start, end = window
+    return lambda t: start <= t.time().strftime("%H:%M") < end
+
+
+if __name__ == "__main__":
+    schedulers = []
+    for window, jobs in schedules:
+        s = schedule.Scheduler()
+        s.allow_at = allow_between(window)
+        for every, to, unit, kwargs in jobs:
+            getattr(s.every(every).to(to), unit).do(real_job, **kwargs)
+        schedulers.append(s)
+
+    # pick up new subscribers and subscriptions
+    schedulers[-1].every(10).minutes.do(reload_subscriptions)
 
+    availability_matrix.load()
     print("scheduled!")
 
     while True:
         current_time = datetime.now()
 
-        for s in (s1, s2, s3):
+        for s in schedulers:
             if s.allow_at(current_time):
                 s.run_pending()
                 time.sleep(0.2)
@@ -0,0 +1,403 @@
+"""
+Backtest polling schedules against recorded availability history.
+
+The restocks recorded in availability_history are the ground truth: every
+time a store / part pair turned available, and until it turned unavailable
+again. A schedule is replayed in simulated time against them, and a restock
+counts as detected by the first poll of its part while it was still
+available. Reported are the detection latency percentiles, the restocks
+missed (sold out before any poll), and the requests spent.
+
+    python simulate_polling.py                                 # the live schedule
+    python simulate_polling.py --config "oldest 2-5m; random 15-60s 07:00-09:30"
+    python simulate_polling.py --config "oldest {}" --values 30-60s 1-3m 2-5m 5-10m
+
+A config is a ';' separated list of jobs, "<target> <every>-<to><s|m|h>
+[HH:MM-HH:MM] [recursive]", where the target is random, oldest, sweep, a part
+number or a name from check_availability.models. With --values, the "{}" in each
+config is replaced by each value, and all the configs are simulated in
+parallel. Custom policies can be passed as the target of a Job from Python:
+a function (simulation, t) -> part index.
+
+A poll is modelled on check_product_availability: fulfillment and
+recommendations (2 requests). Recommendations reveal the parts of the same
+model available at that time; with fewer than 3, their fulfillment is
+requested too (1 request each) and every other part is written as
+unavailable, otherwise they are polled in turn if the job is recursive.
+A sweep requests the parts `sweep_batch_size` per request, at most
+`sweep_max_requests` requests (0 for no limit); a capped sweep resumes where
+the last one stopped, like sweep_products.
+
+Limits: the ground truth is only as fine as the polling that recorded it, and
+the time a poll takes is ignored.
+"""
+import argparse
+import heapq
+import random
+import re
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, NamedTuple
+
+import numpy as np
+
+DAY = 24 * 3600
+UNITS = {"s": 1, "seconds": 1, "m": 60, "minutes": 60, "h": 3600, "hours": 3600}
+MIN_RECOMMENDATIONS = 3  # check_product_availability trusts fewer recommendations to be all there is
+
+
+class Job(NamedTuple):
+    target: str | Callable  # "random", "oldest", "sweep", a part number, or policy(simulation, t) -> part index
+    every: int
+    to: int
+    unit: int = 1  # seconds
+    window: tuple[int, int] | None = None  # seconds since midnight, [start, end)
+    recursive: bool = False
+
+
+class GroundTruth:
+    """
+    Availability intervals per part, in seconds since midnight of the first
+    recorded day.
+    """
+    def __init__(self, parts, families, intervals, origin, horizon):
+        self.parts = parts
+        self.part_index = {part_number: i for i, part_number in enumerate(parts)}
+        self.origin = origin
+        self.horizon = horizon
+        # per part, restocks sorted by start: [start], [end] (end is inf while still available)
+        self.starts = []
+        self.ends = []
+        for part_intervals in intervals:
+            part_intervals.sort()
+            self.starts.append([start for start, _ in part_intervals])
+            self.ends.append([end for _, end in part_intervals])
+
+        # per family (parts of the same model), which of its parts are available when,
+        # as change times and bitmasks of the members available from then on
+        self.families = families
+        self.family_of = [0] * len(parts)
+        self.family_times = []
+        self.family_masks = []
+        for f, members in enumerate(families):
+            changes = []
+            for bit, part in enumerate(members):
+                self.family_of[part] = f
+                changes.extend((start, 1, bit) for start in self.starts[part])
+                changes.extend((end, -1, bit) for end in self.ends[part])
+            changes.sort()
+            counts = [0] * len(members)  # restocks of the member at different stores may overlap
+            times, masks, mask = [], [], 0
+            for t, delta, bit in changes:
+                counts[bit] += delta
+                mask = mask | (1 << bit) if counts[bit] else mask & ~(1 << bit)
+                if times and times[-1] == t:
+                    masks[-1] = mask
+                else:
+                    times.append(t)
+                    masks.append(mask)
+            self.family_times.append(times)
+            self.family_masks.append(masks)
+        self._available_members = {}
+
+    @property
+    def restocks(self):
+        return sum(len(starts) for starts in self.starts)
+
+    def available_in_family(self, part, t) -> tuple[int, ...]:
+        """ The parts of the same model as `part` available at t, including itself """
+        f = self.family_of[part]
+        i = bisect_right(self.family_times[f], t)
+        mask = self.family_masks[f][i - 1] if i else 0
+        if not mask:
+            return ()
+        members = self._available_members.get((f, mask))
+        if members is None:
+            members = tuple(p for bit, p in enumerate(self.families[f]) if mask >> bit & 1)
+            self._available_members[(f, mask)] = members
+        return members
+
+    @classmethod
+    def from_history(cls, since: datetime = None, until: datetime = None):
+        from models import AvailabilityHistory, Product
+
+        query = (
+            AvailabilityHistory
+            .select(
+                AvailabilityHistory.store_number,
+                AvailabilityHistory.part_number,
+                AvailabilityHistory.is_available,
+                AvailabilityHistory.create_time,
+            )
+            .order_by(
+                AvailabilityHistory.store_number,
+                AvailabilityHistory.part_number,
+                AvailabilityHistory.create_time,
+            )
+        )
+        if since:
+            query = query.where(AvailabilityHistory.create_time >= since)
+        if until:
+            query = query.where(AvailabilityHistory.create_time < until)
+        records = list(query.tuples())
+        if not records:
+            raise RuntimeError("No availability history to replay")
+
+        first = min(r[3] for r in records)
+        last = max(r[3] for r in records)
+        origin = datetime.combine((since or first).date(), datetime.min.time())
+        horizon = ((until or last) - origin).total_seconds()
+
+        models = dict(Product.select(Product.part_number, Product.model).tuples())
+        parts = sorted(models.keys() | {r[1] for r in records})
+        part_index = {part_number: i for i, part_number in enumerate(parts)}
+        intervals = [[] for _ in parts]
+
+        pair, start = None, None
+        for store_number, part_number, is_available, create_time in records:
+            if (store_number, part_number) != pair:
+                if start is not None:
+                    intervals[part_index[pair[1]]].append((start, float("inf")))
+                pair, start = (store_number, part_number), None
+            t = (create_time - origin).total_seconds()
+            if is_available and start is None:
+                start = t
+            elif not is_available and start is not None:
+                intervals[part_index[part_number]].append((start, t))
+                start = None
+        if start is not None:
+            intervals[part_index[pair[1]]].append((start, float("inf")))
+
+        by_model = {}
+        for i, part_number in enumerate(parts):
+            by_model.setdefault(models.get(part_number) or part_number, []).append(i)
+        families = list(by_model.values())
+        return cls(parts, families, intervals, origin, horizon)
+
+
+class Simulation:
+    def __init__(self, truth: GroundTruth, jobs: list[Job], seed=0, sweep_batch_size=10, sweep_max_requests=0):
+        self.truth = truth
+        self.jobs = jobs
+        self.sweep_batch_size = sweep_batch_size
+        self.sweep_max_requests = sweep_max_requests
+        self.sweep_cursor = 0  # the part the next capped sweep starts at
+        self.rng = random.Random(seed)
+        n_parts = len(truth.parts)
+        self.pending = [0] * n_parts  # per part, the first restock not yet detected or missed
+        self.last_checked = np.full(n_parts, -np.inf)
+        self.latencies = []
+        self.missed = 0
+        self.polls = 0
+        self.requests = 0
+
+    def next_allowed(self, t, window):
+        if window is None:
+            return t
+        start, end = window
+        time_of_day = t % DAY
+        allowed = start <= time_of_day < end if start < end else time_of_day >= start or time_of_day < end
+        if allowed:
+            return t
+        day = t - time_of_day
+        return day + start if time_of_day < start else day + DAY + start
+
+    def pick(self, job: Job, t) -> int | None:
+        if callable(job.target):
+            return job.target(self, t)
+        if job.target == "random":
+            return self.rng.randrange(len(self.truth.parts))
+        if job.target == "oldest":
+            return int(np.argmin(self.last_checked))
+        return self.truth.part_index.get(job.target)  # None if never recorded
+
+    def detect(self, part, t):
+        """ The part's fulfillment was requested at t """
+        starts, ends = self.truth.starts[part], self.truth.ends[part]
+        last = bisect_right(starts, t)
+        for i in range(self.pending[part], last):
+            if ends[i] > t:
+                self.latencies.append(t - starts[i])
+            else:
+                self.missed += 1
+        self.pending[part] = last
+        self.last_checked[part] = t
+
+    def poll(self, part, t, recursive):
+        self.polls += 1
+        self.requests += 2
+        if part is None:
+            return
+        self.detect(part, t)
+        recommended = [p for p in self.truth.available_in_family(part, t) if p != part]
+        if len(recommended) < MIN_RECOMMENDATIONS:
+            self.requests += len(recommended)
+            for p in recommended:
+                self.detect(p, t)
+            # store_nearly_unavailable writes every other part
+            self.last_checked[:] = t
+        elif recursive:
+            for p in recommended:
+                self.poll(p, t, False)
+
+    def sweep(self, t):
+        n_parts = len(self.truth.parts)
+        count = n_parts
+        if self.sweep_max_requests:
+            count = min(n_parts, self.sweep_max_requests * self.sweep_batch_size)
+        self.polls += 1
+        self.requests += -(-count // self.sweep_batch_size)
+        for i in range(count):
+            self.detect((self.sweep_cursor + i) % n_parts, t)
+        if count < n_parts:
+            self.sweep_cursor = (self.sweep_cursor + count) % n_parts
+
+    def run(self) -> dict:
+        queue = []
+        for n, job in enumerate(self.jobs):
+            heapq.heappush(queue, (self.rng.randint(job.every, job.to) * job.unit, n))
+        while queue:
+            due, n = heapq.heappop(queue)
+            job = self.jobs[n]
+            t = self.next_allowed(due, job.window)
+            if t > self.truth.horizon:
+                continue
+            if t > due:
+                heapq.heappush(queue, (t, n))
+                continue
+            if job.target == "sweep":
+                self.sweep(t)
+            else:
+                self.poll(self.pick(job, t), t, job.recursive)
+            heapq.heappush(queue, (t + self.rng.randint(job.every, job.to) * job.unit, n))
+
+        for part, starts in enumerate(self.truth.starts):
+            ends = self.truth.ends[part]
+            self.missed += sum(1 for i in range(self.pending[part], len(starts)) if ends[i] <= self.truth.horizon)
+        return self.report()
+
+    def report(self) -> dict:
+        latencies = np.array(self.latencies)
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) if len(latencies) else (np.nan,) * 3
+        return dict(
+            days=round(self.truth.horizon / DAY, 1),
+            restocks=self.truth.restocks,
+            detected=len(latencies),
+            missed=self.missed,
+            polls=self.polls,
+            requests=self.requests,
+            p50=p50,
+            p90=p90,
+            p99=p99,
+        )
+
+
+def parse_window(text) -> tuple[int, int]:
+    start, end = text.split("-")
+    to_seconds = lambda hhmm: int(hhmm[:2]) * 3600 + int(hhmm[3:]) * 60
+    return to_seconds(start), to_seconds(end)
+
+
+def parse_job(spec, aliases=None) -> Job:
+    """ "<target> <every>-<to><s|m|h> [HH:MM-HH:MM] [recursive]" """
+    words = spec.split()
+    target = (aliases or {}).get(words[0], words[0])
+    match = re.fullmatch(r"(\d+)-(\d+)([smh])", words[1])
+    if not match:
+        raise ValueError(f"Bad interval {words[1]!r} in {spec!r}, expected e.g. 2-5m")
+    window = next((parse_window(w) for w in words[2:] if re.fullmatch(r"\d\d:\d\d-\d\d:\d\d", w)), None)
+    return Job(target, int(match[1]), int(match[2]), UNITS[match[3]], window, "recursive" in words[2:])
+
+
+def parse_config(config, aliases=None) -> list[Job]:
+    return [parse_job(spec, aliases) for spec in config.split(";") if spec.strip()]
+
+
+def live_schedule() -> list[Job]:
+    """ The jobs of schedule_check_availability.py """
+    from schedule_check_availability import schedules
+
+    jobs = []
+    for window, window_jobs in schedules:
+        for every, to, unit, kwargs in window_jobs:
+            if kwargs.get("randomly"):
+                target, recursive = "random", False
+            elif kwargs.get("sweep"):
+                target, recursive = "sweep", False
+            elif kwargs.get("oldest"):
+                target, recursive = "oldest", True
+            else:
+                target, recursive = kwargs["product"], False
+            jobs.append(Job(target, every, to, UNITS[unit], window and parse_window("-".join(window)), recursive))
+    return jobs
+
+
+_truth = None
+
+
+def _init_worker(truth):
+    global _truth
+    _truth = truth
+
+
+def _simulate(args):
+    name, jobs, seed, sweep_batch_size, sweep_max_requests = args
+    return name, Simulation(_truth, jobs, seed, sweep_batch_size, sweep_max_requests).run()
+
+
+def simulate_many(truth, configs: dict[str, list[Job]], seed=0, workers=None,
+                  sweep_batch_size=10, sweep_max_requests=0) -> dict[str, dict]:
+    """ name -> report, simulated in parallel processes """
+    tasks = [(name, jobs, seed, sweep_batch_size, sweep_max_requests) for name, jobs in configs.items()]
+    if len(tasks) == 1:
+        _init_worker(truth)
+        return dict(map(_simulate, tasks))
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(truth,)) as executor:
+        return dict(executor.map(_simulate, tasks))
+
+
+def format_duration(seconds):
+    if np.isnan(seconds):
+        return "-"
+    return str(timedelta(seconds=round(seconds)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backtest polling schedules against availability history.")
+    parser.add_argument("--config", action="append", help="Jobs separated by ';'. Defaults to the live schedule.")
+    parser.add_argument("--values", nargs="+", help="Values substituted for {} in each config.")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="Replay history from this date.")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="Replay history until this date.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random intervals and picks.")
+    parser.add_argument("--workers", type=int, help="Number of parallel simulations.")
+    args = parser.parse_args()
+
+    from check_availability import models as aliases, SWEEP_BATCH_SIZE, SWEEP_MAX_REQUESTS
+
+    configs = {}
+    for config in args.config or []:
+        for value in args.values or [None]:
+            name = config.replace("{}", value) if value is not None else config
+            configs[name] = parse_config(name, aliases)
+    if not configs:
+        configs["live schedule"] = live_schedule()
+
+    started = datetime.now()
+    truth = GroundTruth.from_history(args.since, args.until)
+    print(f"Loaded {truth.restocks} restocks of {len(truth.parts)} parts "
+          f"in {(datetime.now() - started).total_seconds():.1f}s")
+
+    started = datetime.now()
+    reports = simulate_many(truth, configs, args.seed, args.workers, SWEEP_BATCH_SIZE, SWEEP_MAX_REQUESTS)
+    print(f"Simulated {len(reports)} configs in {(datetime.now() - started).total_seconds():.1f}s\n")
+
+    header = ("config", "requests", "detected", "missed", "p50", "p90", "p99")
+    rows = [
+        (name, r["requests"], r["detected"], r["missed"],
+         format_duration(r["p50"]), format_duration(r["p90"]), format_duration(r["p99"]))
+        for name, r in sorted(reports.items(), key=lambda item: item[1]["p90"])
+    ]
+    widths = [max(len(str(row[i])) for row in [header] + rows) for i in range(len(header))]
+    for row in [header] + rows:
+        print("  ".join(str(value).ljust(width) for value, width in zip(row, widths)))
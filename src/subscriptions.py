@@ -0,0 +1,123 @@
+import threading
+from collections import defaultdict
+
+from models import Product, Store, Subscriber, Subscription, Transition
+from common import logger
+from notify import send_text_to_many
+
+
+class SubscriptionIndex:
+    """
+    Inverted index from (part_number, store_number) to the subscribers waiting
+    for that product at that store.
+
+    Subscriptions that name a product by model / capacity / finish are expanded
+    to the part numbers of the known products when the index is built. A part
+    number seen for the first time is resolved against those subscriptions once,
+    then it is looked up like any other.
+
+    Matching a transition costs O(matches), however many subscriptions there are.
+    """
+    ANY_STORE = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.loaded = False
+        self.subscribers: dict[int, Subscriber] = {}
+        self.by_pair: dict[tuple[str, str | None], set[int]] = defaultdict(set)
+        self.attribute_subscriptions: list[Subscription] = []  # subscriptions without part_number
+        self.resolved_parts: set[str] = set()
+        self.products: dict[str, Product] = {}
+        self.store_names: dict[str, str] = {}
+
+    def load(self):
+        """ (Re)build the index from the database """
+        subscribers = {s.id: s for s in Subscriber.select().where(Subscriber.is_active == True)}
+        subscriptions = list(Subscription.select().where(Subscription.subscriber.in_(list(subscribers))))
+        products = {p.part_number: p for p in Product.select()}
+        store_names = {s.store_number: s.name for s in Store.select()}
+
+        with self._lock:
+            self.subscribers = subscribers
+            self.products = products
+            self.store_names = store_names
+            self.by_pair = defaultdict(set)
+            self.attribute_subscriptions = []
+            self.resolved_parts = set(products)
+
+            for subscription in subscriptions:
+                if subscription.part_number is not None:
+                    self._add(subscription.part_number, subscription)
+                else:
+                    self.attribute_subscriptions.append(subscription)
+                    for product in products.values():
+                        if subscription.matches_product(product):
+                            self._add(product.part_number, subscription)
+            self.loaded = True
+
+        logger.info("Subscription index: %d subscriptions of %d subscribers, %d keys",
+                    len(subscriptions), len(subscribers), len(self.by_pair))
+
+    def _add(self, part_number, subscription: Subscription):
+        self.by_pair[(part_number, subscription.store_number)].add(subscription.subscriber_id)
+
+    def _resolve_part(self, part_number):
+        """ Expand the attribute subscriptions to a part number not seen at load time """
+        product = Product.get_or_none(Product.part_number == part_number)
+        with self._lock:
+            self.resolved_parts.add(part_number)
+            if product is None:
+                return
+            self.products[part_number] = product
+            for subscription in self.attribute_subscriptions:
+                if subscription.matches_product(product):
+                    self._add(part_number, subscription)
+
+    def match(self, part_number, store_number) -> set[int]:
+        """ Ids of the subscribers interested in the product at the store """
+        if not self.loaded:
+            self.load()
+        if part_number not in self.resolved_parts:
+            self._resolve_part(part_number)
+        return self.by_pair.get((part_number, store_number), set()) \
+            | self.by_pair.get((part_number, self.ANY_STORE), set())
+
+    def describe(self, transition: Transition) -> str:
+        product = self.products.get(transition.part_number)
+        store_name = self.store_names.get(transition.store_number, transition.store_number)
+        name = f"{transition.part_number} {product.capacity}-{product.finish}" if product else transition.part_number
+        if transition.is_available:
+            return f"{name} is available at {store_name}."
+        return f"{name} sold out at {store_name}."
+
+
+subscription_index = SubscriptionIndex()
+
+
+def notify_subscribers(transitions: list[Transition], index: SubscriptionIndex = subscription_index):
+    """
+    Fan out availability transitions to the matching subscribers.
+
+    Each subscriber gets one message listing all their matches, and subscribers
+    receiving the same message at the same PushDeer server share requests.
+    """
+    if not transitions:
+        return
+
+    matched: dict[int, list[str]] = defaultdict(list)
+    for transition in transitions:
+        for subscriber_id in index.match(transition.part_number, transition.store_number):
+            matched[subscriber_id].append(index.describe(transition))
+
+    outbox: dict[tuple[str | None, str], list[str]] = defaultdict(list)
+    for subscriber_id, lines in matched.items():
+        subscriber = index.subscribers[subscriber_id]
+        outbox[(subscriber.push_url, "\n".join(lines))].append(subscriber.push_key)
+
+    logger.info("Notifying %d subscribers of %d transitions in %d messages", len(matched), len(transitions), len(outbox))
+    for (url, text), push_keys in outbox.items():
+        send_text_to_many(text, push_keys, url=url)
+
+
+if __name__ == "__main__":
+    subscription_index.load()
@@ -0,0 +1,209 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:
+    # httpx is only needed by the HTTP/2 transport
+    httpx = None
+
+
+HTTP_TRANSPORT = os.environ.get('APP_HTTP_TRANSPORT', 'requests')
+HTTP_MAX_STREAMS = int(os.environ.get('APP_HTTP_MAX_STREAMS', 8))
+
+
+class TransportError(Exception):
+    """ Network level failure of a transport, whichever library is underneath """
+
+
+class TransportResponse:
+    """
+    The part of an HTTP response we care about, independent of the HTTP library.
+
+    `wire_bytes` is the size of the body as transferred, i.e. before decompression.
+    `from_cache` is set on responses served by the fetch cache instead of a request.
+    """
+    from_cache = False
+
+    def __init__(self, status_code, content, headers, wire_bytes, http_version):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+        self.wire_bytes = wire_bytes
+        self.http_version = http_version
+
+    def __repr__(self):
+        return f"<TransportResponse [{self.status_code}] {self.http_version} {self.wire_bytes} bytes>"
+
+
+class SourceAddressAdapter(HTTPAdapter):
+    """ HTTPAdapter that binds outgoing connections to a local source address """
+    def __init__(self, source_address, **kwargs):
+        self.source_address = source_address
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["source_address"] = (self.source_address, 0)
+        super().init_poolmanager(*args, **kwargs)
+
+
+class Transport:
+    """
+    Base class of HTTP transports.
+
+    A transport holds the connections and the cookies of one egress route.
+    """
+    name = None
+
+    def __init__(self, proxy=None, source_address=None):
+        self.proxy = proxy
+        self.source_address = source_address
+
+    def get(self, url, **kwargs) -> TransportResponse:
+        raise NotImplementedError
+
+    def get_many(self, urls, **kwargs) -> list[TransportResponse | TransportError]:
+        """
+        Fetch several URLs. Failed requests are returned as TransportError
+        instead of being raised, so one failure doesn't lose the other results.
+        """
+        return [self._get_or_error(url, **kwargs) for url in urls]
+
+    def _get_or_error(self, url, **kwargs):
+        try:
+            return self.get(url, **kwargs)
+        except TransportError as e:
+            return e
+
+    def get_cookies(self) -> dict:
+        raise NotImplementedError
+
+    def update_cookies(self, cookies: dict):
+        raise NotImplementedError
+
+    def clear_cookies(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class RequestsTransport(Transport):
+    """ HTTP/1.1 over `requests`, one request per connection at a time """
+    name = "requests"
+
+    def __init__(self, proxy=None, source_address=None):
+        super().__init__(proxy, source_address)
+        self.session = requests.Session()
+        if proxy:
+            self.session.proxies.update({"http": proxy, "https": proxy})
+        if source_address:
+            adapter = SourceAddressAdapter(source_address)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+
+    def get(self, url, **kwargs) -> TransportResponse:
+        try:
+            response = self.session.get(url, **kwargs)
+        except requests.RequestException as e:
+            raise TransportError(str(e)) from e
+
+        # urllib3 counts the bytes pulled from the socket, before decoding
+        wire_bytes = response.raw.tell() if response.raw is not None else len(response.content)
+        return TransportResponse(
+            response.status_code,
+            response.content,
+            response.headers,
+            wire_bytes or len(response.content),
+            "HTTP/1.1",
+        )
+
+    def get_cookies(self) -> dict:
+        return self.session.cookies.get_dict()
+
+    def update_cookies(self, cookies: dict):
+        self.session.cookies.update(cookies)
+
+    def clear_cookies(self):
+        self.session.cookies.clear()
+
+    def close(self):
+        self.session.close()
+
+
+class Http2Transport(Transport):
+    """
+    HTTP/2 over `httpx`.
+
+    Concurrent requests share one connection as separate streams, and responses
+    are negotiated with gzip / brotli compression (brotli requires the `brotli`
+    package). Falls back to HTTP/1.1 if the server doesn't speak HTTP/2.
+
+    With `prior_knowledge`, HTTP/2 is used without negotiation, which allows
+    cleartext (h2c) servers such as the local benchmark stub.
+    """
+    name = "http2"
+
+    def __init__(self, proxy=None, source_address=None, max_streams=HTTP_MAX_STREAMS, prior_knowledge=False):
+        if httpx is None:
+            raise RuntimeError("The http2 transport requires httpx: pip install 'httpx[http2,brotli]'")
+        super().__init__(proxy, source_address)
+        self.max_streams = max_streams
+        transport = httpx.HTTPTransport(
+            http1=not prior_knowledge,
+            http2=True,
+            proxy=proxy,
+            local_address=source_address,
+        )
+        self.client = httpx.Client(transport=transport, follow_redirects=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_streams)
+
+    def get(self, url, **kwargs) -> TransportResponse:
+        try:
+            response = self.client.get(url, **kwargs)
+        except httpx.HTTPError as e:
+            raise TransportError(str(e)) from e
+
+        return TransportResponse(
+            response.status_code,
+            response.content,
+            response.headers,
+            response.num_bytes_downloaded,
+            response.http_version,
+        )
+
+    def get_many(self, urls, **kwargs) -> list[TransportResponse | TransportError]:
+        # httpx.Client is thread-safe: requests issued from the worker threads
+        # become concurrent streams on the same HTTP/2 connection
+        return list(self._executor.map(lambda url: self._get_or_error(url, **kwargs), urls))
+
+    def get_cookies(self) -> dict:
+        return dict(self.client.cookies)
+
+    def update_cookies(self, cookies: dict):
+        self.client.cookies.update(cookies)
+
+    def clear_cookies(self):
+        self.client.cookies.clear()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.client.close()
+
+
+transports = {
+    RequestsTransport.name: RequestsTransport,
+    Http2Transport.name: Http2Transport,
+}
+
+
+def create_transport(name=None, **kwargs) -> Transport:
+    name = name or HTTP_TRANSPORT
+    try:
+        transport_class = transports[name]
+    except KeyError:
+        raise ValueError(f"Unknown HTTP transport {name!r}, choose from {list(transports)}")
+    return transport_class(**kwargs)
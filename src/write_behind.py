@@ -0,0 +1,335 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from peewee import InterfaceError, OperationalError, SqliteDatabase
+
+from models import db, AvailabilityHistory, Transition, SQLITE_PROFILE
+from common import logger
+from subscriptions import notify_subscribers
+
+
+# the SQLite throughput profile relies on the write-behind thread being the only writer
+WRITE_BEHIND = os.environ.get('APP_WRITE_BEHIND') or (isinstance(db, SqliteDatabase) and SQLITE_PROFILE == 'throughput')
+WRITE_BEHIND_JOURNAL = os.environ.get('APP_WRITE_BEHIND_JOURNAL', 'write_behind.journal')
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('APP_WRITE_BEHIND_BATCH_SIZE', 200))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.environ.get('APP_WRITE_BEHIND_FLUSH_INTERVAL', 1))  # seconds
+WRITE_BEHIND_RETRY_INTERVAL = float(os.environ.get('APP_WRITE_BEHIND_RETRY_INTERVAL', 30))  # seconds
+# producers block once this many observations wait for the writer
+WRITE_BEHIND_MAX_PENDING = int(os.environ.get('APP_WRITE_BEHIND_MAX_PENDING', 10000))
+
+# errors meaning "the database can't be reached right now", as opposed to bad data
+DB_UNAVAILABLE_ERRORS = (OperationalError, InterfaceError)
+# ... except these SQLite OperationalErrors: the schema is wrong, retrying won't help
+SCHEMA_ERRORS = ("no such table", "no such column", "has no column")
+
+
+def is_db_unavailable(error) -> bool:
+    return isinstance(error, DB_UNAVAILABLE_ERRORS) and not str(error).startswith(SCHEMA_ERRORS)
+
+
+class Journal:
+    """
+    Append-only file of observations that couldn't be written to the database,
+    one JSON object per line.
+
+    Replay progress is kept in a side file (`<journal>.offset`), so a replay
+    interrupted by another outage resumes where it stopped. A line torn by a
+    crash while appending is cut off, and unreadable lines are skipped.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.offset_path = self.path.with_name(self.path.name + ".offset")
+        self._truncate_torn_line()
+
+    def _truncate_torn_line(self):
+        """ Cut an incomplete last line, so that new lines don't get appended to it """
+        if not self.path.exists():
+            return
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if not data or data.endswith(b"\n"):
+                return
+            end = data.rfind(b"\n") + 1
+            logger.warning("Dropping an incomplete last line of %s (%d bytes)", self.path, len(data) - end)
+            f.truncate(end)
+
+    def append(self, items):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for item in items:
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _read_offset(self):
+        try:
+            return int(self.offset_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _write_offset(self, offset):
+        tmp_path = self.offset_path.with_name(self.offset_path.name + ".tmp")
+        tmp_path.write_text(str(offset))
+        os.replace(tmp_path, self.offset_path)
+
+    def is_empty(self):
+        return not self.path.exists() or self.path.stat().st_size <= self._read_offset()
+
+    def read_batches(self, batch_size):
+        """
+        Yield (items, end_offset) in journal order, starting after what was
+        already replayed. Call `commit(end_offset)` once a batch is written.
+        """
+        with open(self.path, "rb") as f:
+            f.seek(self._read_offset())
+            items = []
+            for line in iter(f.readline, b""):
+                if not line.endswith(b"\n"):
+                    # torn by a crash while appending
+                    logger.warning("Skipping an incomplete line of %s", self.path)
+                    continue
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    logger.warning("Skipping an unreadable line of %s: %r", self.path, line[:200])
+                    continue
+                if len(items) >= batch_size:
+                    yield items, f.tell()
+                    items = []
+            if items:
+                yield items, f.tell()
+
+    def commit(self, offset):
+        self._write_offset(offset)
+
+    def clear(self):
+        self.path.unlink(missing_ok=True)
+        self.offset_path.unlink(missing_ok=True)
+
+
+class WriteBehindQueue:
+    """
+    Decouples persisting observations from fetching them.
+
+    Observations are queued and written by a background thread, batched into
+    one transaction per `batch_size` items or `flush_interval` seconds. While
+    the database is unavailable, batches are spilled to the journal; once it
+    is reachable again, the journal is replayed in order before anything newer.
+
+    Availability transitions found while writing are passed to `on_transitions`.
+    """
+    def __init__(self, journal_path=WRITE_BEHIND_JOURNAL, batch_size=WRITE_BEHIND_BATCH_SIZE,
+                 flush_interval=WRITE_BEHIND_FLUSH_INTERVAL, retry_interval=WRITE_BEHIND_RETRY_INTERVAL,
+                 max_pending=WRITE_BEHIND_MAX_PENDING, on_transitions=None):
+        self.journal = Journal(journal_path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.on_transitions = on_transitions
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._stopping = threading.Event()
+        self._thread = None
+        self._retry_at = 0.0  # monotonic time; nonzero while the database is unavailable
+
+        self.written = 0
+        self.journaled = 0
+        self.replayed = 0
+        self.dropped = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """ Write (or spill) everything queued, then stop the writer thread """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def flush(self, timeout=None):
+        """ Wait until every queued observation is written or journaled """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def set_availability(self, store_number, part_number, is_available, product_details=None):
+        self._queue.put(dict(
+            op="set_availability",
+            store_number=store_number,
+            part_number=part_number,
+            is_available=is_available,
+            product_details=product_details,
+            observed_time=datetime.now().isoformat(),
+        ))
+
+    def set_availability_many(self, observations):
+        """ (store_number, part_number, is_available, product_details) observations, written in bulk """
+        self._queue.put(dict(
+            op="set_availability_many",
+            observations=[list(o) for o in observations],
+            observed_time=datetime.now().isoformat(),
+        ))
+
+    def set_nearly_unavailable(self, available_products):
+        self._queue.put(dict(
+            op="set_nearly_unavailable",
+            available_products=sorted(available_products),
+            observed_time=datetime.now().isoformat(),
+        ))
+
+    def _take_batch(self):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            return batch
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._take_batch()
+            try:
+                self._process(batch)
+            except Exception:
+                # keep the writer alive: producers block once the queue is full
+                logger.exception("Write-behind failed on a batch of %d observations", len(batch))
+                self._retry_at = time.monotonic() + self.retry_interval
+                try:
+                    self._spill(batch)
+                except Exception:
+                    logger.exception("Could not journal %d observations, dropping them", len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _process(self, batch):
+        if self._retry_at and time.monotonic() < self._retry_at:
+            self._spill(batch)
+            return
+
+        if not self.journal.is_empty() and not self._replay():
+            self._spill(batch)
+            return
+
+        if batch and not self._write(batch):
+            self._spill(batch)
+
+    def _spill(self, batch):
+        if batch:
+            self.journal.append(batch)
+            self.journaled += len(batch)
+
+    def _write(self, items) -> bool:
+        """
+        Write items in one transaction; False if the database is unavailable.
+        If some item is bad (e.g. a constraint violation), the batch is written
+        again item by item, dropping only the items that fail.
+        """
+        dropped = self.dropped
+        try:
+            try:
+                transitions = self._apply_all(items)
+            except Exception as e:
+                if is_db_unavailable(e):
+                    raise
+                logger.warning("A batch of %d observations failed, writing them one by one: %s", len(items), e)
+                transitions = self._apply_all(items, one_by_one=True)
+        except Exception as e:
+            if not is_db_unavailable(e):
+                raise
+            logger.error("Database unavailable, spilling to %s: %s", self.journal.path, e)
+            self._retry_at = time.monotonic() + self.retry_interval
+            try:
+                db.close()
+            except Exception:
+                pass
+            return False
+
+        self._retry_at = 0.0
+        written = len(items) - (self.dropped - dropped)
+        self.written += written
+        logger.debug("Wrote %d observations", written)
+        if transitions and self.on_transitions:
+            self.on_transitions(transitions)
+        return True
+
+    def _apply_all(self, items, one_by_one=False) -> list[Transition]:
+        """
+        Apply items in one transaction. One by one, each item gets a savepoint:
+        an item that fails is rolled back and dropped, unless the database is
+        unavailable, which fails the whole transaction.
+        """
+        transitions = []
+        with db.atomic():
+            for item in items:
+                if not one_by_one:
+                    transitions.extend(self._apply(item))
+                    continue
+                try:
+                    with db.atomic():
+                        transitions.extend(self._apply(item))
+                except Exception as e:
+                    if is_db_unavailable(e):
+                        raise
+                    # bad data or a wrong schema would fail again on every retry, don't keep it
+                    logger.error("Dropping a %s observation of %s: %s",
+                                 item.get("op"), item.get("observed_time"), e)
+                    self.dropped += 1
+        return transitions
+
+    def _replay(self) -> bool:
+        """ Write the journal in order; False if the database went away again """
+        logger.info("Replaying %s", self.journal.path)
+        for items, offset in self.journal.read_batches(self.batch_size):
+            if not self._write(items):
+                return False
+            self.journal.commit(offset)
+            self.replayed += len(items)
+        self.journal.clear()
+        logger.info("Replayed %d observations from the journal", self.replayed)
+        return True
+
+    @staticmethod
+    def _apply(item) -> list[Transition]:
+        observed_time = datetime.fromisoformat(item["observed_time"])
+        if item["op"] == "set_availability":
+            transition = AvailabilityHistory.set_availability(
+                item["store_number"],
+                item["part_number"],
+                item["is_available"],
+                product_details=item["product_details"],
+                observed_time=observed_time,
+            )
+            return [transition] if transition else []
+        if item["op"] == "set_availability_many":
+            return AvailabilityHistory.set_availability_many(item["observations"], observed_time)
+        if item["op"] == "set_nearly_unavailable":
+            return AvailabilityHistory.set_nearly_unavailable(item["available_products"], observed_time)
+        raise ValueError(f"Unknown write-behind operation {item['op']!r}")
+
+
+write_behind_queue = None
+if WRITE_BEHIND and isinstance(db, SqliteDatabase) and db.database == ':memory:':
+    # every thread gets its own in-memory database, the writer would never see our tables
+    logger.warning("Write-behind is disabled: it needs a database shared between threads, set APP_DB_PATH")
+elif WRITE_BEHIND:
+    write_behind_queue = WriteBehindQueue(on_transitions=notify_subscribers).start()
+    atexit.register(write_behind_queue.stop)